@@ -0,0 +1,5 @@
+"""Client of the EBI web services (InterPro, Proteins API, Europe PMC) and its response cache,
+shared by the curation scripts"""
+
+from .cache import cache_from_config, response_cache
+from .fetch import api_client, rate_limiter
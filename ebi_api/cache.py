@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import os, sqlite3, threading
+from time import time
+from urllib.parse import urlsplit, urlunsplit
+
+
+class response_cache:
+    # Time to live (hours) of cached responses, per endpoint. Endpoints are matched
+    # on the start of the URL (host and path), the longest prefix wins
+    ENDPOINTS = {
+        "interpro": "www.ebi.ac.uk/interpro/api/",
+        "proteins": "www.ebi.ac.uk/proteins/api/",
+        "europepmc": "www.ebi.ac.uk/europepmc/",
+    }
+    TTLS = {"interpro": 24 * 7, "proteins": 24 * 7, "europepmc": 24, "default": 24}
+
+    def __init__(self, path, max_size=1024, ttls=None):
+        """
+		SQLite-backed cache of HTTP responses, keyed by URL.
+
+		Stale responses are kept, and revalidated with their ETag/Last-Modified
+		headers. Once the total size goes over `max_size` MB, the least recently
+		used responses are evicted.
+		The cache can be shared by threads and processes.
+		"""
+        self.path = path
+        self.max_size = int(max_size * 1024 * 1024)
+        ttls = dict(self.TTLS, **(ttls or {}))
+        self.default_ttl = ttls.pop("default") * 3600
+        self.ttls = sorted(
+            ((self.ENDPOINTS[name], hours * 3600) for name, hours in ttls.items()),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+        self.local = threading.local()
+
+        con = self.get_connection()
+        con.executescript(
+            """
+            create table if not exists response (
+                url text primary key,
+                body blob not null,
+                etag text,
+                last_modified text,
+                fetched real not null,
+                accessed real not null,
+                size integer not null
+            );
+            create index if not exists response_accessed on response (accessed);
+            create table if not exists total (id integer primary key check (id = 0), size integer not null);
+            insert or ignore into total values (0, 0);
+            create trigger if not exists response_insert after insert on response
+                begin update total set size = size + new.size; end;
+            create trigger if not exists response_delete after delete on response
+                begin update total set size = size - old.size; end;
+            create trigger if not exists response_update after update of size on response
+                begin update total set size = size - old.size + new.size; end;
+            """
+        )
+        self.evict()
+
+    def get_connection(self):
+        # connections cannot be shared across processes, nor used by several threads at once
+        if getattr(self.local, "pid", None) != os.getpid():
+            con = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            con.execute("pragma journal_mode=wal")
+            con.execute("pragma synchronous=normal")
+            self.local.con = con
+            self.local.pid = os.getpid()
+        return self.local.con
+
+    @staticmethod
+    def get_key(url):
+        # the default port does not change the resource
+        url_parts = urlsplit(url)
+        netloc = url_parts.netloc
+        if (url_parts.scheme, url_parts.port) in (("https", 443), ("http", 80)):
+            netloc = url_parts.hostname
+        return urlunsplit(url_parts._replace(netloc=netloc))
+
+    def get_ttl(self, key):
+        location = key.split("://", 1)[-1]
+        for prefix, ttl in self.ttls:
+            if location.startswith(prefix):
+                return ttl
+        return self.default_ttl
+
+    def get(self, url):
+        """
+		Return (body, fresh, headers) of a cached response, or None.
+		headers are the conditional request headers to revalidate a stale response
+		"""
+        key = self.get_key(url)
+        con = self.get_connection()
+        row = con.execute(
+            "select body, etag, last_modified, fetched from response where url = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        body, etag, last_modified, fetched = row
+        now = time()
+        con.execute("update response set accessed = ? where url = ?", (now, key))
+
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return body, now - fetched < self.get_ttl(key), headers
+
+    def put(self, url, body, etag=None, last_modified=None):
+        key = self.get_key(url)
+        now = time()
+        con = self.get_connection()
+        # an upsert fires the update trigger, "insert or replace" would not fire the delete trigger
+        con.execute(
+            """
+            insert into response values (?, ?, ?, ?, ?, ?, ?)
+            on conflict (url) do update set
+                body = excluded.body,
+                etag = excluded.etag,
+                last_modified = excluded.last_modified,
+                fetched = excluded.fetched,
+                accessed = excluded.accessed,
+                size = excluded.size
+            """,
+            (key, body, etag, last_modified, now, now, len(key) + len(body)),
+        )
+        self.evict()
+
+    def revalidated(self, url):
+        # the server confirmed (304) that the cached response is still valid
+        now = time()
+        self.get_connection().execute(
+            "update response set fetched = ?, accessed = ? where url = ?", (now, now, self.get_key(url))
+        )
+
+    def evict(self):
+        con = self.get_connection()
+        (size,) = con.execute("select size from total").fetchone()
+        if size <= self.max_size:
+            return
+
+        # evict down to 90% of the maximum size, so that this is not done on every put
+        con.execute("begin immediate")
+        try:
+            # another process may have evicted in the meantime
+            (size,) = con.execute("select size from total").fetchone()
+            excess = size - self.max_size * 0.9
+            urls = []
+            for url, url_size in con.execute("select url, size from response order by accessed"):
+                if excess <= 0:
+                    break
+                urls.append((url,))
+                excess -= url_size
+            con.executemany("delete from response where url = ?", urls)
+            con.execute("commit")
+        except BaseException:
+            con.execute("rollback")
+            raise
+
+
+def cache_from_config(config, default_path=None):
+    """
+	Return the response cache described in the [cache] section of a configuration,
+	or None if no path is given
+	"""
+    path = config.get("cache", "path", fallback="") or default_path
+    if not path:
+        return None
+
+    ttls = {}
+    for name in list(response_cache.ENDPOINTS) + ["default"]:
+        hours = config.get("cache", f"ttl_{name}", fallback="")
+        if hours:
+            ttls[name] = float(hours)
+    max_size = config.getfloat("cache", "max_size", fallback=1024)
+    return response_cache(path, max_size, ttls)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import sys, json, ssl, random, threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urljoin
+
+
+class rate_limiter:
+    def __init__(self, rate):
+        """
+		Shared by threads: requests start at most `rate` times per second
+		"""
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+
+        if start > now:
+            sleep(start - now)
+
+
+class api_client:
+    # Status codes retried with exponential backoff
+    RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+    # Redirections followed before giving up
+    MAX_REDIRECTS = 5
+
+    def __init__(self, workers=8, rate=10, attempts=6, backoff=2, max_backoff=120, timeout=300, cache=None):
+        """
+		Concurrent JSON API client.
+
+		Each thread keeps its own keep-alive connection per host, and requests
+		of all threads go through a shared rate limiter.
+		If a response cache is given, fresh responses are served from it without
+		any request, and stale ones are revalidated.
+		"""
+        self.workers = workers
+        self.cache = cache
+        self.limiter = rate_limiter(rate)
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        # disable SSL verification to avoid config issues
+        self.context = ssl._create_unverified_context()
+        self.local = threading.local()
+
+    def get_connection(self, scheme, host):
+        connections = self.local.__dict__.setdefault("connections", {})
+        try:
+            return connections[(scheme, host)]
+        except KeyError:
+            if scheme == "https":
+                con = http.client.HTTPSConnection(host, timeout=self.timeout, context=self.context)
+            else:
+                con = http.client.HTTPConnection(host, timeout=self.timeout)
+            connections[(scheme, host)] = con
+            return con
+
+    def close_connection(self, scheme, host):
+        connections = self.local.__dict__.get("connections", {})
+        con = connections.pop((scheme, host), None)
+        if con is not None:
+            con.close()
+
+    def get_json(self, url, headers=None):
+        """
+		Return the decoded JSON payload of a URL, or None if there is no content (204).
+		408, 429, 5xx and connection errors are retried with exponential backoff
+		"""
+        cached = self.cache.get(url) if self.cache else None
+        if cached:
+            body, fresh, conditional_headers = cached
+            if fresh:
+                return self.decode(body)
+            headers = dict(conditional_headers, **(headers or {}))
+
+        original_url = url
+        attempt = 0
+        redirects = 0
+        while True:
+            url_parts = urlsplit(url)
+            path = url_parts.path + (f"?{url_parts.query}" if url_parts.query else "")
+            con = self.get_connection(url_parts.scheme, url_parts.netloc)
+            request_headers = {"Accept": "application/json"}
+            request_headers.update(headers or {})
+
+            self.limiter.wait()
+            try:
+                con.request("GET", path, headers=request_headers)
+                res = con.getresponse()
+                # the whole body is read, so that the connection can be reused
+                body = res.read()
+            except (http.client.HTTPException, OSError) as e:
+                self.close_connection(url_parts.scheme, url_parts.netloc)
+                status, reason, res_headers = None, str(e), {}
+            else:
+                status, reason, res_headers = res.status, res.reason, res.headers
+                if res.will_close:
+                    self.close_connection(url_parts.scheme, url_parts.netloc)
+
+            if status in (200, 204):
+                if self.cache:
+                    self.cache.put(
+                        original_url, body, res_headers.get("ETag"), res_headers.get("Last-Modified")
+                    )
+                return self.decode(body)
+            elif status == 304 and cached:
+                self.cache.revalidated(original_url)
+                return self.decode(cached[0])
+            elif (
+                status in (301, 302, 303, 307, 308)
+                and res_headers.get("Location")
+                and redirects < self.MAX_REDIRECTS
+            ):
+                # Location may be relative to the requested URL
+                url = urljoin(url, res_headers["Location"])
+                redirects += 1
+                continue
+            elif (status is None or status in self.RETRY_STATUS) and attempt < self.attempts:
+                attempt += 1
+                sleep(self.get_delay(attempt, res_headers))
+                continue
+
+            sys.stderr.write(f"LAST URL: {url}\n")
+            raise HTTPError(url, status or 0, reason, res_headers, None)
+
+    @staticmethod
+    def decode(body):
+        return json.loads(body.decode()) if body else None
+
+    def get_delay(self, attempt, headers):
+        retry_after = headers.get("Retry-After") if headers else None
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), self.max_backoff)
+
+        # exponential backoff, with jitter so that threads do not retry together
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * random.uniform(0.5, 1)
+
+    def map(self, func, items):
+        """
+		Apply func to items with a pool of `workers` threads, returning results in order
+		"""
+        items = list(items)
+        if self.workers <= 1:
+            return [func(item) for item in items]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(func, items))
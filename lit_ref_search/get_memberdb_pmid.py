@@ -6,12 +6,16 @@ import argparse
 from configparser import ConfigParser
 from multiprocessing import Pool
 
+from ebi_api import api_client, cache_from_config
+
 
 class memberdb_pmid:
-    def __init__(self, member_db, boringfile):
+    def __init__(self, member_db, boringfile, cache=None):
         self.load_boring_pmids(boringfile)
         self.database = member_db
         self.sign_in = list()
+        # Proteins API requests, one every 5 seconds (cached responses are not requested)
+        self.client = api_client(workers=1, rate=0.2, cache=cache)
 
     def load_boring_pmids(self, boringfile):
         print("Loading boring PMIDs into memory")
@@ -150,53 +154,11 @@ class memberdb_pmid:
         return list_pmid_acc
 
     def search_pmid(self, accession):
-        # disable SSL verification to avoid config issues
-        context = ssl._create_unverified_context()
-        next = f"https://www.ebi.ac.uk/proteins/api/proteins/{accession}"
-        attempts = 0
-
-        while next:
-            try:
-                sleep(5)
-                req = request.Request(next, headers={"Accept": "application/json"})
-                # res = request.urlopen(req, context=context)
-                with request.urlopen(req) as res:
-                    # If the API times out due a long running query
-                    if res.status == 408:
-                        # wait just over a minute
-                        sleep(61)
-                        # then continue this loop with the same URL
-                        continue
-                    elif res.status == 204:
-                        # no data so leave loop
-                        break
-                    payload = json.loads(res.read().decode())
-                    next = ""
-                    attemps = 0
-            except HTTPError as e:
-                if e.code == 408:
-                    sleep(61)
-                    continue
-                else:
-                    # If there is a different HTTP error, it wil re-try 3 times before failing
-                    if attempts < 3:
-                        attempts += 1
-                        sleep(61)
-                        continue
-                    else:
-                        print("LAST URL: " + next)
-                        print(e)
-                        next = ""
-            except http.client.RemoteDisconnected as e:
-                # http.client.RemoteDisconnected
-                if attempts < 3:
-                    attempts += 1
-                    sleep(61)
-                    continue
-                else:
-                    print("LAST URL: " + next)
-                    print(e)
-                    next = ""
+        try:
+            payload = self.client.get_json(f"https://www.ebi.ac.uk/proteins/api/proteins/{accession}")
+        except HTTPError as e:
+            print(e)
+            payload = None
 
         list_pmids = set()
         pmid = ""
@@ -233,7 +195,7 @@ if __name__ == "__main__":
     boringpmidf = config["files"]["boringpmidfile"]
 
     # init
-    process = memberdb_pmid(database, boringpmidf)
+    process = memberdb_pmid(database, boringpmidf, cache_from_config(config))
 
     if not os.path.isfile(inputf):
         parser.error(f"Error file not found '{inputf}'")
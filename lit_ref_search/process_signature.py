@@ -4,12 +4,13 @@ from urllib.error import HTTPError
 from time import sleep
 import argparse
 from configparser import ConfigParser
+from ebi_api import cache_from_config
 from get_memberdb_pmid import memberdb_pmid
 
 
 class signature_pmid(memberdb_pmid):
-    def __init__(self, member_db, boringfile, signature):
-        super().__init__(member_db, boringfile)
+    def __init__(self, member_db, boringfile, signature, cache=None):
+        super().__init__(member_db, boringfile, cache)
         self.signature = signature
 
 
@@ -29,7 +30,7 @@ if __name__ == "__main__":
     boringpmidf = config["files"]["boringpmidfile"]
 
     # init
-    process = signature_pmid(database, boringpmidf, args.signature)
+    process = signature_pmid(database, boringpmidf, args.signature, cache_from_config(config))
     if process.has_swissprot(process.signature):
         print(f"Signature '{process.signature}' also matching SwissProt")
     else:
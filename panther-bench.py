@@ -0,0 +1,401 @@
+"""
+# Benchmark panther-cli.py on synthetic PANTHER releases (no Oracle/Pronto access needed)
+
+# Default scales (1000, 5000 and 20000 families), results written to JSON
+$ python panther-bench.py -o bench.json
+
+# Larger releases, compared with an earlier run (exit status 1 if a benchmark is >20% slower)
+$ python panther-bench.py --scales 20000 80000 --workdir /scratch/panther-bench --baseline bench.json -o bench-new.json
+"""
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import types
+from datetime import datetime
+
+
+CLI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "panther-cli.py")
+
+
+def load_cli(path=CLI_PATH):
+    # panther-cli.py is not importable by name (hyphen)
+    spec = importlib.util.spec_from_file_location("panther_cli", path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that objects of the module can be pickled (worker processes)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def protein_acc(i):
+    return f"B{i:08d}"
+
+
+def is_reviewed(i, fraction):
+    # Fixed for a given protein, across releases
+    return (i * 2654435761) % 2 ** 32 < fraction * 2 ** 32
+
+
+def generate_release(families, proteins_per_family, zipf, seed):
+    """Return a release as {signature: [protein index, ...]}.
+
+    Family sizes follow a Zipf distribution, and each family is split into
+    subfamilies (PTHRnnnnn:SFn), as in PANTHER.
+    """
+    rnd = random.Random(seed)
+    num_proteins = families * proteins_per_family
+    harmonic = sum(1 / (k + 1) ** zipf for k in range(families))
+    sizes = [
+        max(1, min(num_proteins, round(num_proteins / harmonic / (k + 1) ** zipf)))
+        for k in range(families)
+    ]
+    rnd.shuffle(sizes)
+
+    release = {}
+    for i, size in enumerate(sizes):
+        family = f"PTHR{10000 + i}"
+        proteins = rnd.sample(range(num_proteins), size)
+        release[family] = sorted(proteins)
+
+        num_subfamilies = rnd.randint(0, min(10, size // 3))
+        for j in range(num_subfamilies):
+            subfamily = proteins[j::num_subfamilies]
+            release[f"{family}:SF{j}"] = sorted(subfamily)
+
+    return release
+
+
+def churn(release, rate, proteins_per_family, seed):
+    """Return the next version of a release: signatures are deleted
+    (half of them replaced by a renamed copy), updated, or added."""
+    rnd = random.Random(seed)
+    num_proteins = len([acc for acc in release if ":" not in acc]) * proteins_per_family
+    next_family = 1 + max(int(acc[4:].split(":")[0]) for acc in release)
+    released = {}
+    for acc, proteins in release.items():
+        r = rnd.random()
+        if r < rate:
+            if rnd.random() < 0.5:
+                # Renamed: a new subfamily of the same family, with most proteins
+                family = acc.split(":")[0]
+                renamed = f"{family}:SF{100 + rnd.randrange(900)}"
+                kept = [p for p in proteins if rnd.random() >= 0.05]
+                released[renamed] = sorted(set(kept or proteins))
+        elif r < 2 * rate:
+            # Updated: ~5% of proteins removed, and as many added
+            n = max(1, len(proteins) // 20)
+            kept = [p for p in proteins if rnd.random() >= 0.05]
+            added = [rnd.randrange(num_proteins) for _ in range(n)]
+            released[acc] = sorted(set(kept + added))
+        else:
+            released[acc] = proteins
+
+    for i in range(int(rate * len(release) / 10)):
+        family = f"PTHR{next_family + i}"
+        released[family] = sorted(rnd.sample(range(num_proteins), rnd.randint(1, 2 * proteins_per_family)))
+
+    return released
+
+
+def to_run(release, reviewed):
+    """Yield the release as a sorted run of (signature, [(accession, is_reviewed), ...])"""
+    for acc in sorted(release):
+        yield acc, [(protein_acc(i), is_reviewed(i, reviewed)) for i in release[acc]]
+
+
+def prepare(cli, directory, args, families, seed):
+    """Generate three consecutive releases and the reference data of Pronto"""
+    os.makedirs(directory, exist_ok=True)
+    dictionary = cli.Dictionary(os.path.join(directory, "proteins.dict"))
+    dictionary.open()
+
+    releases = [generate_release(families, args.proteins_per_family, args.zipf, seed)]
+    for i in range(2):
+        releases.append(churn(releases[-1], args.churn, args.proteins_per_family, seed + i + 1))
+
+    paths = []
+    for i, release in enumerate(releases):
+        path = os.path.join(directory, f"release{i}")
+        metadata = {"synthetic": {"families": families, "seed": seed}}
+        cli.File(path).write([to_run(release, args.reviewed)], dictionary, metadata=metadata)
+        paths.append(path)
+
+    dictionary.close()
+
+    rnd = random.Random(seed)
+    now, nxt = releases[0], releases[1]
+    integrated = {
+        acc: f"IPR{i:06d}"
+        for i, acc in enumerate(sorted(now))
+        if rnd.random() < 0.6
+    }
+    deleted = {acc: e_acc for acc, e_acc in integrated.items() if acc not in nxt}
+
+    reviewed = sorted({i for proteins in now.values() for i in proteins if is_reviewed(i, args.reviewed)})
+    fragments = [protein_acc(i) for i in rnd.sample(reviewed, len(reviewed) // 50)]
+
+    # Signatures of other databases, overlapping PANTHER families
+    other_db = {}
+    for i, acc in enumerate(rnd.sample(sorted(now), max(1, len(now) // 20))):
+        proteins = [protein_acc(p) for p in now[acc] if is_reviewed(p, args.reviewed)]
+        if proteins:
+            other_db[f"PF{i:05d}"] = proteins
+
+    deleted_path = os.path.join(directory, "deleted.tsv")
+    with open(deleted_path, "wt") as fh:
+        for acc in sorted(deleted):
+            fh.write(f"{deleted[acc]}\t{acc}\n")
+
+    context = {
+        "families": families,
+        "releases": paths,
+        "deleted": deleted_path,
+        "signatures": len(now),
+        "matches": sum(len(proteins) for proteins in now.values()),
+        "integrated": integrated,
+        "fragments": fragments,
+        "other_db": other_db
+    }
+    with open(os.path.join(directory, "context.json"), "wt") as fh:
+        json.dump(context, fh)
+
+    return context
+
+
+def go_offline(cli, context):
+    """Replace the Oracle/Pronto queries of the CLI by the synthetic reference data"""
+    integrated = context["integrated"]
+    fragments = set(context["fragments"])
+    other_db = {acc: set(proteins) for acc, proteins in context["other_db"].items()}
+    signatures = {acc: "IPR999999" for acc in other_db}
+
+    cli.get_integrated = lambda url: integrated
+    cli.get_fragments = lambda url: fragments
+    cli.replacements_otherdb = lambda url, pronto_url: (other_db, signatures)
+
+
+def bench_export(cli, context, directory):
+    """Spill matches into runs and merge them into an export, as `export` does.
+    Matches are read from the first release, in random order."""
+    now = cli.File(context["releases"][0])
+    dictionary = cli.open_releases(now)
+    rows = [
+        (acc, dictionary[protein_id], reviewed)
+        for acc in now
+        for protein_id, reviewed in now[acc]
+    ]
+    random.Random(0).shuffle(rows)
+    now.close()
+
+    def run():
+        tmpdir = tempfile.mkdtemp(dir=directory)
+        runs = cli.Runs(tmpdir, compression="zlib")
+        for method_acc, acc, reviewed in rows:
+            runs.add(method_acc, acc, reviewed)
+        runs.spill()
+
+        cli.File(os.path.join(directory, "export")).write(runs.files, dictionary)
+        dictionary.close()
+        shutil.rmtree(tmpdir)
+
+    return run
+
+
+def run_command(func, **kwargs):
+    """Benchmark of a subcommand, `func` returning its function in the CLI"""
+    def bench(cli, context, directory):
+        args = types.SimpleNamespace(cache=None, refresh=False, **kwargs)
+        return lambda: func(cli)("x", "y", args)
+
+    return bench
+
+
+def command_benchmarks(context, workers):
+    f1, f2, f3 = context["releases"][0], context["releases"][1], context["deleted"]
+    find_args = dict(f1=f1, f2=f2, f3=f3, approx=False, exact=None, workers=1,
+                     output=None, format="tsv", chunk_size=1000, resume=False)
+    benchmarks = {
+        "export": bench_export,
+        "list": run_command(lambda cli: cli.list_deleted, f1=f1, f2=f2),
+        "find": run_command(lambda cli: cli.find_replacements, **find_args),
+        "find-approx": run_command(lambda cli: cli.find_replacements, **dict(find_args, approx=True)),
+        "diff": run_command(lambda cli: cli.find_sequences, f1=f1, f2=f2, output=None,
+                            format="tsv", tmpdir=None, run_size=1000000),
+        "lineage": run_command(lambda cli: cli.trace_lineage, files=context["releases"],
+                               sequences=None, tmpdir=None, run_size=1000000),
+    }
+    if workers > 1:
+        benchmarks[f"find-{workers}-workers"] = run_command(lambda cli: cli.find_replacements,
+                                                            **dict(find_args, workers=workers))
+
+    return benchmarks
+
+
+def isolated(conn, func, *args):
+    """Run a function in a child process, sending back its result and resources used"""
+    try:
+        # Output of the CLI is not part of the benchmark
+        sys.stdout = sys.stderr = open(os.devnull, "wt")
+        result = func(*args)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in kilobytes on Linux
+        conn.send((True, (result, max(usage.ru_maxrss, children.ru_maxrss) * 1024)))
+    except BaseException:
+        conn.send((False, traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def run_isolated(func, *args):
+    """Run a function in a forked process, so that the memory peak is its own"""
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=isolated, args=(child_conn, func) + args)
+    process.start()
+    child_conn.close()
+    ok, value = parent_conn.recv()
+    process.join()
+    if not ok:
+        raise RuntimeError(value)
+
+    return value
+
+
+def benchmark(cli, context, func, directory):
+    """Set up a benchmark, then return the wall and CPU times of its run"""
+    go_offline(cli, context)
+    run = func(cli, context, directory)
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    run()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # Includes worker processes
+    cpu = time.process_time() - cpu_start + children.ru_utime + children.ru_stime
+    return time.perf_counter() - start, cpu
+
+
+def compare(results, baseline, tolerance):
+    """Return the benchmarks slower than in the baseline by more than `tolerance`"""
+    previous = {(r["families"], r["benchmark"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        other = previous.get((r["families"], r["benchmark"]))
+        if other and r["wall"] > other["wall"] * (1 + tolerance):
+            regressions.append((r, other))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PANTHER update helper benchmarks")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 5000, 20000],
+                        help="number of families of the synthetic releases (default: 1000 5000 20000)")
+    parser.add_argument("--proteins-per-family", type=int, default=40,
+                        help="size of the protein space, per family (default: 40)")
+    parser.add_argument("--zipf", type=float, default=1.1,
+                        help="exponent of the Zipf distribution of family sizes (default: 1.1)")
+    parser.add_argument("--reviewed", type=float, default=0.05,
+                        help="fraction of reviewed proteins (default: 0.05)")
+    parser.add_argument("--churn", type=float, default=0.1,
+                        help="fraction of signatures deleted, and updated, between releases (default: 0.1)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="also benchmark find with this number of workers (default: 4)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs per benchmark, the fastest is reported (default: 1)")
+    parser.add_argument("--only", nargs="+", metavar="BENCHMARK",
+                        help="benchmarks to run (default: all)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default: 1)")
+    parser.add_argument("--workdir", help="directory for releases (default: temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="keep generated releases")
+    parser.add_argument("--baseline", metavar="FILE", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown above which a benchmark is a regression (default: 0.2)")
+    parser.add_argument("-o", "--output", metavar="FILE", help="JSON results (default: stdout)")
+    parser.add_argument("--cli", default=CLI_PATH, help="path to panther-cli.py")
+    args = parser.parse_args()
+
+    cli = load_cli(args.cli)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="panther-bench-")
+    results = []
+    try:
+        for families in args.scales:
+            directory = os.path.join(workdir, str(families))
+            start = time.perf_counter()
+            context, _ = run_isolated(prepare, cli, directory, args, families, args.seed)
+            sys.stderr.write(f"{families} families: {context['signatures']} signatures, "
+                             f"{context['matches']} matches "
+                             f"(generated in {time.perf_counter() - start:.1f}s)\n")
+
+            for name, func in command_benchmarks(context, args.workers).items():
+                if args.only and name not in args.only:
+                    continue
+
+                runs = [run_isolated(benchmark, cli, context, func, directory)
+                        for _ in range(args.repeat)]
+                (wall, cpu), _ = min(runs)
+                max_rss = max(rss for _, rss in runs)
+                results.append({
+                    "families": families,
+                    "signatures": context["signatures"],
+                    "matches": context["matches"],
+                    "benchmark": name,
+                    "wall": wall,
+                    "cpu": cpu,
+                    "max_rss": max_rss,
+                    "matches_per_sec": context["matches"] / wall if wall else None
+                })
+                sys.stderr.write(f"  {name:<22} {wall:>9.2f}s  cpu {cpu:>9.2f}s  "
+                                 f"rss {max_rss / 1024 ** 2:>9.1f}MB\n")
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir)
+
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": {
+            "proteins_per_family": args.proteins_per_family,
+            "zipf": args.zipf,
+            "reviewed": args.reviewed,
+            "churn": args.churn,
+            "seed": args.seed
+        },
+        "results": results
+    }
+
+    if args.output:
+        with open(args.output, "wt") as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+    if args.baseline:
+        with open(args.baseline, "rt") as fh:
+            baseline = json.load(fh)
+
+        regressions = compare(results, baseline, args.tolerance)
+        for r, other in regressions:
+            sys.stderr.write(f"regression: {r['benchmark']} ({r['families']} families): "
+                             f"{other['wall']:.2f}s -> {r['wall']:.2f}s\n")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
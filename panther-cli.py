@@ -1,30 +1,78 @@
 """
 # Find potential replacements for deleted signatures when updating PANTHER
 
-# Export PANTHER matches (memory: ~2GB)
+# Export PANTHER matches (memory: ~2GB, or bounded with --memory-budget)
 $ export INTERPRO_URL="interpro/*******@IPPRO"
-$ python panther-cli.py export -a 84 -o /hps/nobackup/agb/interpro/typhaine/panther/panther15
-$ python panther-cli.py export -a 101 -o /hps/nobackup/agb/interpro/typhaine/panther/panther17
+$ python panther-cli.py export -a 84 -p 8 -o /hps/nobackup/agb/interpro/typhaine/panther/panther15 -d /hps/nobackup/agb/interpro/typhaine/panther/proteins.dict
+$ python panther-cli.py export -a 101 --memory-budget 2G -o /hps/nobackup/agb/interpro/typhaine/panther/panther17 -d /hps/nobackup/agb/interpro/typhaine/panther/proteins.dict
 
-# Find replacements for deleted signatures (memory: ~20GB)
-$ python panther-cli.py find -1 /hps/nobackup/agb/interpro/mblum/panther/panther15 -2 /hps/nobackup/agb/interpro/typhaine/panther/panther17 > /hps/nobackup/agb/interpro/typhaine/panther/replacements.tsv
+# Update an export with the proteins changed in UniParc since (same analysis)
+$ python panther-cli.py export -a 101 --base /hps/nobackup/agb/interpro/typhaine/panther/panther17 -o /hps/nobackup/agb/interpro/typhaine/panther/panther17.1 -d /hps/nobackup/agb/interpro/typhaine/panther/proteins.dict
+
+# Find replacements for deleted signatures (memory: exports are memory-mapped, only the reviewed proteins of deleted
+# signatures and of other databases' signatures are loaded, with an index restricted to them)
+$ python panther-cli.py find --workers 8 -1 /hps/nobackup/agb/interpro/mblum/panther/panther15 -2 /hps/nobackup/agb/interpro/typhaine/panther/panther17 -3 deleted.tsv > /hps/nobackup/agb/interpro/typhaine/panther/replacements.tsv
+
+# Write replacements in committed chunks, and resume after an interruption (e.g. preemption)
+$ python panther-cli.py find --workers 8 --resume -o /hps/nobackup/agb/interpro/typhaine/panther/replacements.tsv -1 /hps/nobackup/agb/interpro/mblum/panther/panther15 -2 /hps/nobackup/agb/interpro/typhaine/panther/panther17 -3 deleted.tsv
+
+# Explore replacements with MinHash sketches (candidates verified exactly), reporting the recall of an exact run
+$ python panther-cli.py find --approx --exact /hps/nobackup/agb/interpro/typhaine/panther/replacements.tsv -1 /hps/nobackup/agb/interpro/mblum/panther/panther15 -2 /hps/nobackup/agb/interpro/typhaine/panther/panther17 -3 deleted.tsv > /hps/nobackup/agb/interpro/typhaine/panther/replacements_approx.tsv
+
+# Reuse Pronto reference data (fragments, other signatures, ENTRY2METHOD) across runs
+$ python panther-cli.py find --cache /hps/nobackup/agb/interpro/typhaine/panther/cache -1 /hps/nobackup/agb/interpro/mblum/panther/panther15 -2 /hps/nobackup/agb/interpro/typhaine/panther/panther17 -3 deleted.tsv > /hps/nobackup/agb/interpro/typhaine/panther/replacements.tsv
 
 # List deleted signatures
 $ python panther-cli.py list -1 /hps/nobackup/agb/interpro/mblum/panther/panther15 -2 /hps/nobackup/agb/interpro/typhaine/panther/panther17
 
-# List gained and lost proteins (memory: ~8GB)
+# Trace deleted signatures over several versions (replacement chains), with the gained/lost proteins of each step
+$ python panther-cli.py lineage --sequences /hps/nobackup/agb/interpro/typhaine/panther/lineage_sequences.tsv /hps/nobackup/agb/interpro/mblum/panther/panther15 /hps/nobackup/agb/interpro/typhaine/panther/panther16 /hps/nobackup/agb/interpro/typhaine/panther/panther17 > /hps/nobackup/agb/interpro/typhaine/panther/lineage.tsv
+
+# Answer lookups over exports: /signature/PTHR10000:SF3, /protein/P12345, /jaccard?a=PTHR10000&b=PTHR10000:SF3
+$ python panther-cli.py serve --port 8000 /hps/nobackup/agb/interpro/mblum/panther/panther15 /hps/nobackup/agb/interpro/typhaine/panther/panther17
+$ curl "http://127.0.0.1:8000/signature/PTHR10000:SF3?release=panther17&accessions=reviewed"
+
+# Report where time and memory go (per phase), e.g. to size cluster requests
+$ python panther-cli.py diff --profile --profile-json diff-profile.json -1 /hps/nobackup/agb/interpro/mblum/panther/panther15 -2 /hps/nobackup/agb/interpro/typhaine/panther/panther17 > /hps/nobackup/agb/interpro/typhaine/panther/sequences.tsv
+
+# List gained and lost proteins (memory: bounded by --run-size, ~1GB by default)
 $ python panther-cli.py diff -1 /hps/nobackup/agb/interpro/mblum/panther/panther15 -2 /hps/nobackup/agb/interpro/typhaine/panther/panther17 > /hps/nobackup/agb/interpro/typhaine/panther/sequences.tsv
+
+# Write replacements or gained/lost proteins as typed columns (Parquet or Arrow IPC, requires pyarrow)
+$ python panther-cli.py find --format parquet -o /hps/nobackup/agb/interpro/typhaine/panther/replacements.parquet -1 /hps/nobackup/agb/interpro/mblum/panther/panther15 -2 /hps/nobackup/agb/interpro/typhaine/panther/panther17 -3 deleted.tsv
+$ python panther-cli.py diff --format arrow -o /hps/nobackup/agb/interpro/typhaine/panther/sequences.arrow -1 /hps/nobackup/agb/interpro/mblum/panther/panther15 -2 /hps/nobackup/agb/interpro/typhaine/panther/panther17
 """
 
 import argparse
+import bisect
+import fcntl
+import gc
+import gzip
+import hashlib
 import heapq
+import io
+import json
+import lzma
+import math
+import mmap
+import multiprocessing
 import os
 import pickle
 import re
+import resource
 import shutil
 import struct
 import sys
 import tempfile
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from functools import lru_cache, wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import accumulate, groupby
+from urllib.parse import parse_qs, unquote, urlsplit
 import psycopg2
 
 import cx_Oracle
@@ -32,14 +80,480 @@ import cx_Oracle
 
 MIN_SIMILARITY = 0.80
 
+# MinHash sketches: NUM_BANDS bands of BAND_SIZE hash values each.
+# With a Jaccard index of 0.8, a pair collides in at least one band
+# with a probability > 0.999, while pairs below 0.3 rarely do.
+NUM_BANDS = 20
+BAND_SIZE = 5
+NUM_HASHES = NUM_BANDS * BAND_SIZE
+SKETCH_VERSION = 2
+
+
+def cpu_time():
+    """CPU time of the process and of its terminated children (workers)"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def peak_rss():
+    """Peak resident set size, in bytes, of the process since the last reset_peak_rss()"""
+    try:
+        with open("/proc/self/status", "rt") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # Without /proc: peak of the whole process (ru_maxrss is in kilobytes)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def children_peak_rss():
+    """Peak resident set size, in bytes, of the largest terminated child (workers)"""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process to its current size (Linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "wt") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0
+        self.cpu = 0
+        self.rows = 0
+        self.peak_rss = 0
+
+
+class Profiler:
+    """Wall time, CPU time, rows and peak RSS of the phases of a command.
+
+    Phases can be nested: the time of a nested phase is not counted in its
+    parent. Phases of the same name are accumulated. When the profiler is
+    disabled, phases only cost a function call.
+
+    On Linux, the peak RSS of the process is reset when a phase starts, so
+    that each phase reports its own peak (including its nested phases, and
+    workers terminated during the phase). Elsewhere, it is the peak of the
+    process so far.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self.stack = []
+        self.unused = Phase(None)
+        self.max_rss = 0
+
+    def start(self, name):
+        """Start a phase, and return it (its `rows` can be incremented)"""
+        if not self.enabled:
+            return self.unused
+
+        try:
+            phase = self.phases[name]
+        except KeyError:
+            phase = self.phases[name] = Phase(name)
+
+        if self.stack:
+            # Peak of the enclosing phase so far, before it is reset
+            self.stack[-1][5] = max(self.stack[-1][5], peak_rss())
+        reset_peak_rss()
+
+        # [phase, wall at start, CPU at start, wall of nested phases, CPU of nested phases,
+        #  peak RSS before the last reset, peak RSS of children at start]
+        self.stack.append([phase, time.perf_counter(), cpu_time(), 0, 0, 0, children_peak_rss()])
+        return phase
+
+    def stop(self):
+        if not self.enabled:
+            return
+
+        phase, wall, cpu, nested_wall, nested_cpu, rss, children_rss = self.stack.pop()
+        wall = time.perf_counter() - wall
+        cpu = cpu_time() - cpu
+        rss = max(rss, peak_rss())
+        if children_peak_rss() > children_rss:
+            # A worker terminated during the phase used more memory than previous ones
+            rss = max(rss, children_peak_rss())
+
+        phase.calls += 1
+        phase.wall += wall - nested_wall
+        phase.cpu += cpu - nested_cpu
+        phase.peak_rss = max(phase.peak_rss, rss)
+        self.max_rss = max(self.max_rss, rss)
+        if self.stack:
+            self.stack[-1][3] += wall
+            self.stack[-1][4] += cpu
+            self.stack[-1][5] = max(self.stack[-1][5], rss)
+
+    @contextmanager
+    def phase(self, name):
+        phase = self.start(name)
+        try:
+            yield phase
+        finally:
+            self.stop()
+
+    def summary(self):
+        rows = []
+        # Time not attributed to a phase last
+        for phase in sorted(self.phases.values(), key=lambda p: p.name == "other"):
+            rows.append({
+                "phase": phase.name,
+                "calls": phase.calls,
+                "wall": phase.wall,
+                "cpu": phase.cpu,
+                "rows": phase.rows or None,
+                "rows_per_sec": phase.rows / phase.wall if phase.rows and phase.wall else None,
+                "peak_rss": phase.peak_rss
+            })
+        return rows
+
+    def report(self, file=sys.stderr):
+        file.write(f"{'phase':<20}{'calls':>8}{'wall (s)':>12}{'CPU (s)':>12}"
+                   f"{'rows':>14}{'rows/s':>12}{'peak RSS (MB)':>16}\n")
+        for row in self.summary():
+            rows = f"{row['rows']:>14}" if row["rows"] else f"{'-':>14}"
+            speed = f"{row['rows_per_sec']:>12.0f}" if row["rows_per_sec"] else f"{'-':>12}"
+            file.write(f"{row['phase']:<20}{row['calls']:>8}{row['wall']:>12.2f}{row['cpu']:>12.2f}"
+                       f"{rows}{speed}{row['peak_rss'] / 1024 ** 2:>16.1f}\n")
+
+
+profiler = Profiler()
+
+
+def profiled(func, path=None):
+    """Profile a command, printing a summary of its phases, and optionally writing it to JSON"""
+    @wraps(func)
+    def wrapper(*args):
+        profiler.enabled = True
+        start = time.perf_counter()
+        cpu = cpu_time()
+        try:
+            with profiler.phase("other"):
+                return func(*args)
+        finally:
+            total = {
+                "wall": time.perf_counter() - start,
+                "cpu": cpu_time() - cpu,
+                # peak_rss() is reset by phases
+                "peak_rss": max(profiler.max_rss, peak_rss(), children_peak_rss())
+            }
+            profiler.report()
+            sys.stderr.write(f"total: {total['wall']:.2f}s wall, {total['cpu']:.2f}s CPU, "
+                             f"peak RSS {total['peak_rss'] / 1024 ** 2:.1f}MB\n")
+            if path:
+                with open(path, "wt") as fh:
+                    json.dump({
+                        "command": func.__name__,
+                        "argv": sys.argv,
+                        "total": total,
+                        "phases": profiler.summary()
+                    }, fh, indent=2)
+
+    return wrapper
+
+
+class Dictionary:
+    """Global protein accession <-> uint32 identifier mapping.
+
+    Identifiers are assigned on first sight and never change, so exports
+    written with the same dictionary can be compared by identifier.
+    Accessions are stored as fixed-width records, so the accession of an
+    identifier is read from disk without loading the whole dictionary.
+    Exports resolve accessions with a sorted index (<path>.index), also
+    without loading the whole dictionary.
+    """
+
+    WIDTH = 10
+    # Record of the sorted index: accession, identifier
+    INDEX_RECORD = struct.Struct("<10sI")
+
+    def __init__(self, path=None):
+        self.path = path
+        self.fh = None
+        self.mm = None
+        self.size = 0
+        self.ids = None
+        self.new = []
+        self.new_ids = {}
+        self.lock_fh = None
+        self.lock_depth = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.size + len(self.new)
+
+    def __getitem__(self, i):
+        if i >= self.size:
+            return self.new[i - self.size]
+
+        record = self.mm[i * self.WIDTH:(i + 1) * self.WIDTH]
+        return record.rstrip(b"\0").decode()
+
+    def open(self):
+        self.close()
+        self.size = 0
+        if self.path and os.path.isfile(self.path):
+            self.fh = open(self.path, "rb")
+            self.size = os.path.getsize(self.path) // self.WIDTH
+            if self.size:
+                self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def records(self, first=0):
+        chunk = 1000000 * self.WIDTH
+        for start in range(first * self.WIDTH, self.size * self.WIDTH, chunk):
+            data = self.mm[start:start + chunk]
+            for i in range(0, len(data), self.WIDTH):
+                yield data[i:i + self.WIDTH].rstrip(b"\0").decode()
+
+    def load(self):
+        """Load the accession -> identifier mapping in memory"""
+        self.ids = {acc: i for i, acc in enumerate(self.records())}
+        self.ids.update(self.new_ids)
+
+    def intern(self, acc):
+        if self.ids is None:
+            self.load()
+
+        try:
+            return self.ids[acc]
+        except KeyError:
+            i = self.ids[acc] = self.new_ids[acc] = len(self)
+            self.new.append(acc)
+            return i
+
+    def lookup(self, accessions, add=True):
+        """Return the identifiers of the given accessions, without loading the whole mapping.
+
+        Accessions not in the dictionary are assigned new identifiers,
+        or left out if `add` is false.
+        """
+        if self.ids is not None:
+            if not add:
+                return {acc: self.ids[acc] for acc in accessions if acc in self.ids}
+            return {acc: self.intern(acc) for acc in accessions}
+
+        wanted = set(accessions)
+        ids = {}
+        for i, acc in enumerate(self.records()):
+            if acc in wanted:
+                ids[acc] = i
+
+        for acc in wanted:
+            if acc not in ids:
+                try:
+                    ids[acc] = self.new_ids[acc]
+                except KeyError:
+                    if add:
+                        ids[acc] = self.new_ids[acc] = len(self)
+                        self.new.append(acc)
+
+        return ids
+
+    @property
+    def index_path(self):
+        return f"{self.path}.index"
+
+    def index_records(self):
+        """Yield the (accession, identifier) pairs of the index, sorted by accession"""
+        record = self.INDEX_RECORD
+        try:
+            fh = open(self.index_path, "rb")
+        except FileNotFoundError:
+            return
+
+        with fh:
+            for block in iter(lambda: fh.read(record.size * 65536), b""):
+                for acc, protein_id in record.iter_unpack(block):
+                    yield acc.rstrip(b"\0").decode(), protein_id
+
+    def update_index(self, tmpdir=None, run_size=5000000):
+        """Add the records appended since the last update to the sorted index.
+
+        The index (<path>.index) maps accessions to identifiers in accession
+        order, so that accessions are resolved by a merge join instead of
+        loading the whole mapping. Called with the lock held.
+        """
+        try:
+            indexed = os.path.getsize(self.index_path) // self.INDEX_RECORD.size
+        except FileNotFoundError:
+            indexed = 0
+
+        if indexed == self.size:
+            return
+        elif indexed > self.size:
+            # Index of another dictionary: rebuilt
+            indexed = 0
+
+        with profiler.phase("dictionary index") as phase:
+            appended = ExternalSort(tmpdir, run_size)
+            for i, acc in enumerate(self.records(indexed), indexed):
+                appended.add(f"{acc}\t{i}")
+            phase.rows += self.size - indexed
+
+            # The tab sorts before accession characters: keys are sorted by accession
+            keys = (key.split("\t") for key in appended)
+            records = heapq.merge(
+                self.index_records() if indexed else iter(()),
+                ((acc, int(protein_id)) for acc, protein_id in keys)
+            )
+
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "wb") as fh:
+                buffer = []
+                for acc, protein_id in records:
+                    buffer.append(self.INDEX_RECORD.pack(acc.encode(), protein_id))
+                    if len(buffer) == 65536:
+                        fh.write(b"".join(buffer))
+                        buffer.clear()
+                fh.write(b"".join(buffer))
+
+            os.replace(tmp_path, self.index_path)
+            appended.close()
+
+    def join(self, rows):
+        """Resolve (accession, value) rows sorted by accession, yielding (identifier, value).
+
+        Accessions are merged with the sorted index (see update_index), and
+        unknown accessions are assigned new identifiers.
+        """
+        records = self.index_records()
+        current = next(records, None)
+        last = protein_id = None
+        for acc, value in rows:
+            if acc != last:
+                while current is not None and current[0] < acc:
+                    current = next(records, None)
+
+                if current is not None and current[0] == acc:
+                    protein_id = current[1]
+                else:
+                    try:
+                        protein_id = self.new_ids[acc]
+                    except KeyError:
+                        protein_id = self.new_ids[acc] = len(self)
+                        self.new.append(acc)
+                        if self.ids is not None:
+                            self.ids[acc] = protein_id
+
+                last = acc
+
+            yield protein_id, value
+
+    @contextmanager
+    def locked(self):
+        """Hold an exclusive lock on the dictionary file, to assign and append identifiers.
+
+        Writers sharing a dictionary (e.g. concurrent exports) are serialised.
+        Records appended by another writer since open() are read first, so that
+        an identifier is never assigned twice.
+        """
+        if self.lock_depth == 0:
+            self.lock_fh = open(self.path, "ab")
+            fcntl.flock(self.lock_fh, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+            except BaseException:
+                self.unlock()
+                raise
+
+        self.lock_depth += 1
+        try:
+            yield self
+        finally:
+            self.lock_depth -= 1
+            if self.lock_depth == 0:
+                self.unlock()
+
+    def unlock(self):
+        fcntl.flock(self.lock_fh, fcntl.LOCK_UN)
+        self.lock_fh.close()
+        self.lock_fh = None
+
+    def refresh(self):
+        size = os.path.getsize(self.path) // self.WIDTH
+        if size == self.size:
+            return
+        elif self.new:
+            raise RuntimeError(f"{self.path} was modified by another process: "
+                               f"identifiers assigned without the lock are no longer valid")
+
+        first = self.size
+        self.open()
+        if self.ids is not None:
+            for i, acc in enumerate(self.records(first), first):
+                self.ids[acc] = i
+
+    def save(self):
+        """Append new accessions to the dictionary file"""
+        with self.locked():
+            for acc in self.new:
+                record = acc.encode()
+                if len(record) > self.WIDTH:
+                    raise ValueError(f"accession too long: {acc}")
+                self.lock_fh.write(record.ljust(self.WIDTH, b"\0"))
+            self.lock_fh.flush()
+
+            self.new.clear()
+            self.new_ids.clear()
+            self.open()
+
 
 class File:
+    """Signature -> proteins export.
+
+    Layout (little-endian):
+      - header: magic, version, number of signatures, width of signature
+        accessions, length of the JSON metadata, then the metadata
+      - index: one fixed-width record (accession, offset, number of
+        proteins) per signature, sorted by accession
+      - data: for each signature, its sorted uint32 protein identifiers
+        followed by its reviewed bitmap, aligned on 4 bytes
+
+    The file is memory-mapped, and protein sets are zero-copy views over
+    the mapping, so processes reading the same export share the page cache.
+    Exports in the former pickle format can still be read.
+    """
+
+    MAGIC = b"PTHRSET\0"
+    VERSION = 3
+    HEADER = struct.Struct("<8sIIII")
+    RECORD = struct.Struct("<QI")
+
     def __init__(self, path, cached=False):
         self.path = path
         self.fh = None
+        self.mm = None
         self.footer = {}
         self.cached = cached
         self.data = {}
+        self.metadata = {}
+        self.dictionary_path = None
+        self.dictionary = None
 
     def __enter__(self):
         return self
@@ -63,9 +577,21 @@ class File:
         except KeyError:
             pass
 
-        offset = self.footer[key]
-        self.fh.seek(offset)
-        val = ProteinSet(pickle.load(self.fh))
+        if self.mm is not None:
+            offset, count = self.footer[key]
+            view = memoryview(self.mm)
+            end = offset + count * 4
+            ids = view[offset:end].cast("I")
+            if sys.byteorder != "little":
+                ids = array("I", ids)
+                ids.byteswap()
+            val = ProteinSet(ids, view[end:end + (count + 7) // 8])
+        else:
+            # Former format: pickled list of (accession, is_reviewed)
+            offset = self.footer[key]
+            self.fh.seek(offset)
+            val = ProteinSet.from_proteins(pickle.load(self.fh), self.dictionary)
+
         if self.cached:
             self.data[key] = val
         return val
@@ -77,75 +603,548 @@ class File:
     def signatures(self):
         return list(self.footer.keys())
 
-    def write(self, files):
-        with open(self.path, "wb") as fh:
-            offset = fh.write(struct.pack("<Q", 0))
-            footer = {}
+    @property
+    def sketches_path(self):
+        return f"{self.path}.minhash"
+
+    def sketches(self):
+        """Return the MinHash sketches of signatures, computing them if needed"""
+        try:
+            with open(self.sketches_path, "rb") as fh:
+                version, sketches = pickle.load(fh)
+        except (FileNotFoundError, ValueError):
+            pass
+        else:
+            if version == SKETCH_VERSION:
+                return sketches
+
+        sketches = {}
+        for key in self:
+            sketches[key] = minhash(self[key].all)
+
+        self.dump_sketches(sketches)
+        return sketches
+
+    def dump_sketches(self, sketches):
+        with open(self.sketches_path, "wb") as fh:
+            pickle.dump((SKETCH_VERSION, sketches), fh)
+
+    def merge(self, files, buffer_size=io.DEFAULT_BUFFER_SIZE):
+        """Merge sorted runs (paths or iterables), yielding (signature, proteins) pairs"""
+        iterables = [
+            self.load(f, buffer_size) if isinstance(f, str) else f
+            for f in files
+        ]
+        acc = None
+        proteins = []
+
+        for key, values in heapq.merge(*iterables):
+            if key != acc:
+                if acc:
+                    yield acc, proteins
+
+                acc = key
+                proteins = []
+
+            proteins += values
+
+        if acc:
+            yield acc, proteins
+
+    def write(self, files, dictionary, metadata=None, buffer_size=io.DEFAULT_BUFFER_SIZE,
+              sketches=True, tmpdir=None, run_size=5000000):
+        """Write merged runs of (signature, [(accession, reviewed), ...]).
+
+        Accessions are resolved without loading the dictionary: the rows are
+        sorted by accession and joined with the dictionary's sorted index,
+        then sorted back by signature and identifier. Sorts keep at most
+        `run_size` rows in memory, and spill the others into `tmpdir`.
+        """
+        signatures = []
+        index = []
+        signature_sketches = {}
+        data_path = f"{self.path}.data"
+        # Identifiers are assigned and appended under the dictionary's lock
+        with dictionary.locked():
+            # "<accession>\t<signature number><reviewed>" rows
+            rows = ExternalSort(tmpdir, run_size)
+            with profiler.phase("merge") as phase:
+                for acc, proteins in self.merge(files, buffer_size):
+                    number = f"{len(signatures):08x}"
+                    signatures.append(acc)
+                    for protein_acc, is_reviewed in proteins:
+                        rows.add(f"{protein_acc}\t{number}{1 if is_reviewed else 0}")
+                    phase.rows += len(proteins)
+
+            dictionary.update_index(tmpdir, run_size)
+
+            # "<signature number><identifier><reviewed>" rows
+            matches = ExternalSort(tmpdir, run_size)
+            with profiler.phase("identifiers") as phase:
+                for protein_id, value in dictionary.join(row.split("\t") for row in rows):
+                    matches.add(f"{value[:8]}{protein_id:08x}{value[8]}")
+                    phase.rows += 1
+                rows.close()
+
+            with profiler.phase("write") as phase, open(data_path, "wb") as fh:
+                groups = groupby(matches, key=lambda match: match[:8])
+                group = next(groups, None)
+                offset = 0
+                for number, acc in enumerate(signatures):
+                    if group is not None and int(group[0], 16) == number:
+                        val = ProteinSet.from_sorted(
+                            (int(match[8:16], 16), match[16] == "1") for match in group[1]
+                        )
+                        group = next(groups, None)
+                    else:
+                        val = ProteinSet.from_sorted(())
+
+                    index.append((acc, offset, len(val)))
+                    phase.rows += len(val)
 
-            iterables = [self.load(path) for path in files]
-            acc = None
-            proteins = []
+                    ids = val.ids
+                    if sys.byteorder != "little":
+                        ids = array("I", ids)
+                        ids.byteswap()
 
-            for key, values in heapq.merge(*iterables):
-                if key != acc:
-                    if acc:
-                        footer[acc] = offset
-                        offset += fh.write(pickle.dumps(proteins))
+                    offset += fh.write(ids.tobytes())
+                    offset += fh.write(val.mask)
+                    offset += fh.write(b"\0" * (-offset % 4))
+                    if sketches:
+                        signature_sketches[acc] = minhash(val.ids)
+                matches.close()
 
-                    acc = key
-                    proteins.clear()
+            metadata = dict(metadata or {})
+            metadata["dictionary"] = os.path.abspath(dictionary.path)
+            metadata = json.dumps(metadata).encode()
+            width = max((len(acc) for acc, _, _ in index), default=0)
 
-                proteins += values
+            start = self.HEADER.size + len(metadata)
+            start += -start % 8
+            data_start = start + len(index) * (width + self.RECORD.size)
+            data_start += -data_start % 8
 
-            if acc:
-                footer[acc] = offset
-                offset += fh.write(pickle.dumps(proteins))
+            with open(self.path, "wb") as fh:
+                fh.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(index), width, len(metadata)))
+                fh.write(metadata)
+                fh.write(b"\0" * (start - fh.tell()))
 
-            pickle.dump(footer, fh)
-            fh.seek(0)
-            fh.write(struct.pack("<Q", offset))
+                for acc, offset, count in index:
+                    fh.write(acc.encode().ljust(width, b"\0"))
+                    fh.write(self.RECORD.pack(data_start + offset, count))
+
+                fh.write(b"\0" * (data_start - fh.tell()))
+                with open(data_path, "rb") as fh2:
+                    shutil.copyfileobj(fh2, fh, 16 * 1024 * 1024)
+
+            os.remove(data_path)
+            dictionary.save()
+
+        if sketches:
+            self.dump_sketches(signature_sketches)
 
     def open(self):
         self.close()
         self.fh = open(self.path, "rb")
-        offset, = struct.unpack("<Q", self.fh.read(8))
-        self.fh.seek(offset)
-        self.footer = pickle.load(self.fh)
+        magic = self.fh.read(len(self.MAGIC))
+
+        if magic != self.MAGIC:
+            self.fh.seek(0)
+            offset, = struct.unpack("<Q", self.fh.read(8))
+            self.fh.seek(offset)
+            self.footer = pickle.load(self.fh)
+            return
+
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        _, version, size, width, length = self.HEADER.unpack_from(self.mm)
+        if version != self.VERSION:
+            raise ValueError(f"{self.path}: unsupported version {version}")
+
+        self.metadata = json.loads(self.mm[self.HEADER.size:self.HEADER.size + length])
+        self.dictionary_path = self.metadata["dictionary"]
+
+        pos = self.HEADER.size + length
+        pos += -pos % 8
+        self.footer = {}
+        for _ in range(size):
+            acc = self.mm[pos:pos + width].rstrip(b"\0").decode()
+            self.footer[acc] = self.RECORD.unpack_from(self.mm, pos + width)
+            pos += width + self.RECORD.size
+
+    def max_identifier(self):
+        """Return the largest protein identifier, or -1 if there is none"""
+        largest = -1
+        if self.mm is not None:
+            # Identifiers of a signature are sorted: the last one is its largest
+            for offset, count in self.footer.values():
+                if count:
+                    protein_id, = struct.unpack_from("<I", self.mm, offset + (count - 1) * 4)
+                    largest = max(largest, protein_id)
+        return largest
 
     def close(self):
+        self.data.clear()
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                # Protein sets still reference the mapping: released with them
+                pass
+            self.mm = None
+
         if self.fh is not None:
             self.fh.close()
             self.fh = None
 
     @staticmethod
-    def dump(cache, file):
-        with open(file, "wb") as fh:
-            for key in sorted(cache):
-                pickle.dump((key, cache[key]), fh)
+    def dump(cache, file, compression=None):
+        with open(file, "wb") as raw:
+            if compression == "zlib":
+                fh = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=1)
+            elif compression == "lzma":
+                fh = lzma.LZMAFile(raw, mode="wb", preset=1)
+            else:
+                fh = raw
+
+            with fh:
+                for key in sorted(cache):
+                    pickle.dump((key, cache[key]), fh)
 
     @staticmethod
-    def load(file):
-        with open(file, "rb") as fh:
-            while True:
-                try:
-                    item = pickle.load(fh)
-                except EOFError:
-                    break
-                else:
-                    yield item
+    def load(file, buffer_size=io.DEFAULT_BUFFER_SIZE):
+        with open(file, "rb", buffering=buffer_size) as raw:
+            # Compression is detected from the magic number
+            magic = raw.peek(6)[:6]
+            if magic[:2] == b"\x1f\x8b":
+                fh = io.BufferedReader(gzip.GzipFile(fileobj=raw, mode="rb"), buffer_size)
+            elif magic == b"\xfd7zXZ\x00":
+                fh = io.BufferedReader(lzma.LZMAFile(raw, mode="rb"), buffer_size)
+            else:
+                fh = raw
+
+            with fh:
+                while True:
+                    try:
+                        item = pickle.load(fh)
+                    except EOFError:
+                        break
+                    else:
+                        yield item
 
 
 class ProteinSet:
-    def __init__(self, proteins):
-        self.data = proteins
+    """Proteins matched by a signature: sorted identifiers and a reviewed bitmask"""
+
+    def __init__(self, ids, mask):
+        self.ids = ids
+        self.mask = mask
+        self._reviewed = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        """Yield (identifier, is_reviewed) pairs"""
+        for i, protein_id in enumerate(self.ids):
+            yield protein_id, bool(self.mask[i >> 3] >> (i & 7) & 1)
+
+    @classmethod
+    def from_proteins(cls, proteins, dictionary):
+        reviewed = {}
+        for acc, is_reviewed in proteins:
+            protein_id = dictionary.intern(acc)
+            reviewed[protein_id] = reviewed.get(protein_id, False) or is_reviewed
+
+        ids = array("I", sorted(reviewed))
+        mask = bytearray((len(ids) + 7) // 8)
+        for i, protein_id in enumerate(ids):
+            if reviewed[protein_id]:
+                mask[i >> 3] |= 1 << (i & 7)
+
+        return cls(ids, bytes(mask))
+
+    @classmethod
+    def from_sorted(cls, proteins):
+        """Build a set from (identifier, is_reviewed) pairs sorted by identifier,
+        where an identifier can be repeated"""
+        ids = array("I")
+        flags = []
+        for protein_id, is_reviewed in proteins:
+            if ids and ids[-1] == protein_id:
+                flags[-1] = flags[-1] or is_reviewed
+            else:
+                ids.append(protein_id)
+                flags.append(is_reviewed)
+
+        mask = bytearray((len(ids) + 7) // 8)
+        for i, is_reviewed in enumerate(flags):
+            if is_reviewed:
+                mask[i >> 3] |= 1 << (i & 7)
+
+        return cls(ids, bytes(mask))
 
     @property
     def all(self):
-        return {acc for acc, reviewed in self.data}
+        return self.ids
 
     @property
     def reviewed(self):
-        return {acc for acc, reviewed in self.data if reviewed}
+        if self._reviewed is None:
+            self._reviewed = array("I", (protein_id for protein_id, is_reviewed in self if is_reviewed))
+        return self._reviewed
+
+
+def exclude(ids, excluded):
+    """Return the sorted identifiers that are not in the `excluded` set"""
+    if not excluded:
+        return ids
+    return array("I", (protein_id for protein_id in ids if protein_id not in excluded))
+
+
+def count_common(a, b):
+    """Return the number of identifiers shared by two sorted arrays"""
+    if len(a) > len(b):
+        a, b = b, a
+
+    count = 0
+    if len(a) * 16 < len(b):
+        # Much smaller set: search its identifiers in the larger one
+        lo = 0
+        for protein_id in a:
+            lo = bisect.bisect_left(b, protein_id, lo)
+            if lo == len(b):
+                break
+            elif b[lo] == protein_id:
+                count += 1
+                lo += 1
+        return count
+
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            count += 1
+            i += 1
+            j += 1
+    return count
+
+
+def open_releases(*files):
+    """Open exports and attach a shared protein dictionary to them"""
+    for f in files:
+        f.open()
+
+    paths = {f.dictionary_path for f in files if f.dictionary_path}
+    if len(paths) > 1:
+        raise ValueError(f"exports use different protein dictionaries: {', '.join(sorted(paths))}")
+
+    dictionary = Dictionary(paths.pop() if paths else None)
+    if dictionary.path and not os.path.isfile(dictionary.path):
+        # An empty dictionary would assign identifiers already used by the exports
+        raise FileNotFoundError(f"protein dictionary not found: {dictionary.path}")
+
+    dictionary.open()
+    for f in files:
+        if f.dictionary_path and f.max_identifier() >= len(dictionary):
+            raise ValueError(f"{f.path}: identifiers beyond the {len(dictionary)} "
+                             f"proteins of {dictionary.path}")
+        f.dictionary = dictionary
+
+    return dictionary
+
+
+class SimilarityJoin:
+    """Exact set-similarity join with size and prefix filtering (AllPairs).
+
+    Indexed sets are restricted to the proteins that occur in queries (the
+    only ones that can be shared), but their full size is kept to compute
+    the Jaccard index. Proteins are ranked by increasing frequency, so that
+    prefixes are made of rare proteins and posting lists stay short.
+    """
+
+    # Tolerance on bounds, so that filters never reject a pair that the
+    # floating-point similarity would accept
+    EPSILON = 1e-9
+
+    def __init__(self, proteins, threshold=MIN_SIMILARITY):
+        self.proteins = proteins
+        self.threshold = threshold
+        self.keys = []
+        self.positions = {}
+        self.sizes = []
+        self.sets = []
+        self.postings = {}
+        self.ranks = {}
+
+    def add(self, key, proteins):
+        self.positions[key] = len(self.keys)
+        self.keys.append(key)
+        self.sizes.append(len(proteins))
+        self.sets.append([acc for acc in proteins if acc in self.proteins])
+
+    def build(self):
+        frequencies = {}
+        for proteins in self.sets:
+            for acc in proteins:
+                frequencies[acc] = frequencies.get(acc, 0) + 1
+
+        self.ranks = {
+            acc: i
+            for i, acc in enumerate(sorted(frequencies, key=lambda k: (frequencies[k], k)))
+        }
+
+        for i, proteins in enumerate(self.sets):
+            proteins.sort(key=self.ranks.__getitem__)
+            prefix = len(proteins) - self.min_overlap(self.sizes[i]) + 1
+            for acc in proteins[:prefix]:
+                try:
+                    self.postings[acc].append(i)
+                except KeyError:
+                    self.postings[acc] = [i]
+
+            self.sets[i] = frozenset(proteins)
+
+    def min_overlap(self, size):
+        # A pair with a Jaccard index >= threshold shares at least threshold * size proteins
+        return math.ceil(self.threshold * size - self.EPSILON)
+
+    def search(self, proteins, extra=None):
+        """Yield (key, size, common) for each signature that may reach the threshold.
+
+        `extra` is a key to report whenever it shares at least one protein,
+        regardless of its similarity.
+        """
+        size = len(proteins)
+        lower = self.threshold * size - self.EPSILON
+        upper = size / self.threshold + self.EPSILON
+        # Proteins absent from the index rank first: they have no posting
+        ranked = sorted(proteins, key=lambda acc: self.ranks.get(acc, -1))
+        prefix = size - self.min_overlap(size) + 1
+
+        candidates = set()
+        for acc in ranked[:prefix]:
+            for i in self.postings.get(acc, []):
+                if lower <= self.sizes[i] <= upper:
+                    candidates.add(i)
+
+        if extra in self.positions:
+            candidates.add(self.positions[extra])
+
+        for i in sorted(candidates):
+            common = len(self.sets[i].intersection(proteins))
+            if common:
+                yield self.keys[i], self.sizes[i], common
+
+class MinHashIndex:
+    """Locality-sensitive hashing index over MinHash sketches.
+
+    Signatures colliding with a query in at least one band are verified
+    against their exact protein set, returned by `getter`.
+    """
+
+    def __init__(self, getter):
+        self.getter = getter
+        self.keys = []
+        self.positions = {}
+        self.bands = [{} for _ in range(NUM_BANDS)]
+
+    def add(self, key, sketch):
+        i = len(self.keys)
+        self.positions[key] = i
+        self.keys.append(key)
+
+        if sketch is None:
+            return
+
+        for band, buckets in zip(split_bands(sketch), self.bands):
+            try:
+                buckets[band].append(i)
+            except KeyError:
+                buckets[band] = [i]
+
+    def search(self, proteins, extra=None):
+        """Yield (key, size, common) for each candidate sharing at least one protein"""
+        candidates = set()
+        sketch = minhash(proteins)
+        if sketch is not None:
+            for band, buckets in zip(split_bands(sketch), self.bands):
+                candidates.update(buckets.get(band, []))
+
+        if extra in self.positions:
+            candidates.add(self.positions[extra])
+
+        for i in sorted(candidates):
+            key = self.keys[i]
+            other_proteins = self.getter(key)
+            common = count_common(other_proteins, proteins)
+            if common:
+                yield key, len(other_proteins), common
+
+
+def hash_protein(protein_id):
+    # SplitMix64 finalizer, truncated to 56 bits to leave room for the offsets added by densification
+    z = (protein_id + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return (z ^ (z >> 31)) >> 8
+
+
+def minhash(proteins):
+    """Compute a one-permutation MinHash sketch with rotation densification.
+
+    Each protein is hashed once and assigned to one of NUM_HASHES bins,
+    each bin keeping its minimum. Empty bins borrow the value of the next
+    non-empty bin. Returns None for an empty set.
+    """
+    empty = 1 << 64
+    bins = [empty] * NUM_HASHES
+    for acc in proteins:
+        h = hash_protein(acc)
+        i = h % NUM_HASHES
+        value = h // NUM_HASHES
+        if value < bins[i]:
+            bins[i] = value
+
+    if all(value == empty for value in bins):
+        return None
+
+    offset = ((1 << 56) // NUM_HASHES) + 1
+    sketch = array("Q")
+    for i in range(NUM_HASHES):
+        distance = 0
+        while bins[(i + distance) % NUM_HASHES] == empty:
+            distance += 1
+
+        sketch.append(bins[(i + distance) % NUM_HASHES] + distance * offset)
+
+    return sketch
+
+
+def split_bands(sketch):
+    for i in range(NUM_BANDS):
+        yield sketch[i * BAND_SIZE:(i + 1) * BAND_SIZE].tobytes()
+
+
+def load_replacement_pairs(path):
+    """Load (deleted signature, candidate) pairs from the output of `find`"""
+    pairs = set()
+    s_acc = None
+    with open(path) as fh:
+        for line in fh:
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) < 5:
+                continue
+            elif cols[0]:
+                s_acc = cols[0]
+
+            if cols[2] != "-":
+                pairs.add((s_acc, cols[2]))
+
+    return pairs
+
 
 def get_fragments(pronto_uri):
     con = connect_pg(pronto_uri)
@@ -158,72 +1157,265 @@ def get_fragments(pronto_uri):
         AND is_reviewed = 't'
     """)
 
-    fragments = set(cur.fetchall())
+    fragments = {acc for acc, in cur}
     cur.close()
     con.close()
 
     return fragments
 
 
-def export(uri, pronto_uri, args):
-    
-    file = File(args.o)
-    tmpdir = f"{args.o}_tmp"
-    try:
-        shutil.rmtree(tmpdir)
-    except FileNotFoundError:
-        pass
+def get_snapshot(uri, analysis_id):
+    """Return the highest UPI with matches of the analysis, and the current database time.
+
+    Sequences above the highest UPI of UniParc may not have been analysed yet,
+    while their cross-references are not updated when they are: the next
+    incremental export must fetch every UPI above the last one with matches.
+    """
+    con = cx_Oracle.connect(uri)
+    cur = con.cursor()
+    cur.execute(
+        """
+        SELECT MAX(UPI), SYSDATE
+        FROM IPRSCAN.IPM_PANTHER_MATCH@ISPRO
+        WHERE ANALYSIS_ID = :analysis_id
+        """,
+        {"analysis_id": analysis_id}
+    )
+    max_upi, timestamp = cur.fetchone()
+    cur.close()
+    con.close()
+    return max_upi, timestamp
 
-    os.makedirs(tmpdir)
 
+def get_changed_proteins(uri, max_upi, timestamp):
+    """Return UniProt accessions whose cross-reference changed since a snapshot,
+    or that belong to sequences added after it (deleted ones included)"""
     con = cx_Oracle.connect(uri)
     cur = con.cursor()
     cur.execute(
         """
-        SELECT DISTINCT M.METHOD_AC, P.AC, P.DBID
-        FROM IPRSCAN.IPM_PANTHER_MATCH@ISPRO M
-        INNER JOIN (
-            SELECT UPI, AC, DBID
-            FROM UNIPARC.XREF
-            WHERE DBID = 2
-            AND DELETED = 'N'
-        ) P ON M.UPI = P.UPI
-        WHERE M.ANALYSIS_ID = :1
+        SELECT DISTINCT AC
+        FROM UNIPARC.XREF
+        WHERE DBID = 2
+        AND (TIMESTAMP > :since OR UPI > :max_upi)
         """,
-        [args.a]
+        {"since": timestamp, "max_upi": max_upi}
     )
+    changed = {acc for acc, in cur}
+    cur.close()
+    con.close()
+    return changed
+
+
+def get_upi_ranges(max_upi, partitions):
+    """Split UniParc into `partitions` ranges of UPIs of similar widths"""
+    # UPIs are "UPI" followed by a 10-digit hexadecimal number
+    end = int(max_upi[3:], 16) + 1
+    step = math.ceil(end / partitions)
+    bounds = [f"UPI{min(i * step, end):010X}" for i in range(partitions + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
 
-    cache = {}
-    files = []
-    i = 0
-    for method_acc, protein_acc, database_id in cur:
-        is_reviewed = database_id == 2
 
-        # if protein_acc in fragments:
-        #     continue
-        
+class Runs:
+    """Accumulate the proteins of signatures, spilling them into sorted runs.
+
+    Runs are spilled every 1e6 rows, or, with a memory budget, when the
+    estimated size of the cached rows reaches it.
+    """
+
+    # Estimated size, in bytes, of a cached (accession, is_reviewed) row
+    # (tuple, string, list slot), excluding the characters of the accession
+    ROW_SIZE = 120
+    # Estimated size of a new signature in the cache (string, list, dict slot)
+    KEY_SIZE = 250
+
+    def __init__(self, tmpdir, budget=None, compression=None):
+        self.tmpdir = tmpdir
+        self.budget = budget
+        self.compression = compression
+        self.cache = {}
+        self.files = []
+        self.rows = 0
+        self.size = 0
+
+    def add(self, method_acc, protein_acc, is_reviewed):
         try:
-            cache[method_acc].append((protein_acc, is_reviewed))
+            self.cache[method_acc].append((protein_acc, is_reviewed))
         except KeyError:
-            cache[method_acc] = [(protein_acc, is_reviewed)]
+            self.cache[method_acc] = [(protein_acc, is_reviewed)]
+            self.size += self.KEY_SIZE
+
+        self.rows += 1
+        self.size += self.ROW_SIZE + len(protein_acc)
+        if self.budget:
+            if self.size >= self.budget:
+                self.spill()
+        elif self.rows % 1e6 == 0:
+            self.spill()
+
+    def spill(self):
+        if self.cache:
+            with profiler.phase("spill") as phase:
+                fd, path = tempfile.mkstemp(dir=self.tmpdir)
+                File.dump(self.cache, fd, self.compression)
+                phase.rows += sum(len(proteins) for proteins in self.cache.values())
+                self.cache.clear()
+                self.files.append(path)
+
+        self.size = 0
+
+
+def parse_size(value):
+    """Parse a size in bytes, with an optional K/M/G suffix"""
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMG]?)B?", value.strip().upper())
+    if not m:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+
+    number, unit = m.groups()
+    return int(float(number) * 1024 ** " KMG".index(unit or " "))
+
+
+def export_matches(uri, analysis_id, tmpdir, low=None, high=None, arraysize=None,
+                   budget=None, compression=None, since=None):
+    """Fetch PANTHER matches (optionally for UPIs in [low, high)),
+    spilling them into sorted runs in `tmpdir`. Returns the paths of runs.
+
+    `since` is a (max UPI, timestamp) snapshot: only proteins changed
+    after it are fetched.
+    """
+    params = {"analysis_id": analysis_id}
+    xref_filter = match_filter = ""
+    if low is not None:
+        params.update({"low": low, "high": high})
+        xref_filter = "AND UPI >= :low AND UPI < :high"
+        match_filter = "AND M.UPI >= :low AND M.UPI < :high"
+
+    if since is not None:
+        params.update({"max_upi": since[0], "since": since[1]})
+        xref_filter += " AND (TIMESTAMP > :since OR UPI > :max_upi)"
+
+    with profiler.phase("oracle fetch") as phase:
+        con = cx_Oracle.connect(uri)
+        cur = con.cursor()
+        if arraysize:
+            cur.arraysize = arraysize
+            cur.prefetchrows = arraysize + 1
+
+        cur.execute(
+            f"""
+            SELECT DISTINCT M.METHOD_AC, P.AC, P.DBID
+            FROM IPRSCAN.IPM_PANTHER_MATCH@ISPRO M
+            INNER JOIN (
+                SELECT UPI, AC, DBID
+                FROM UNIPARC.XREF
+                WHERE DBID = 2
+                AND DELETED = 'N'
+                {xref_filter}
+            ) P ON M.UPI = P.UPI
+            WHERE M.ANALYSIS_ID = :analysis_id
+            {match_filter}
+            """,
+            params
+        )
+
+        runs = Runs(tmpdir, budget, compression)
+        for method_acc, protein_acc, database_id in cur:
+            is_reviewed = database_id == 2
+
+            # if protein_acc in fragments:
+            #     continue
 
-        i += 1
-        if i % 1e6 == 0:
-            fd, path = tempfile.mkstemp(dir=tmpdir)
-            file.dump(cache, fd)
-            cache.clear()
-            files.append(path)
+            runs.add(method_acc, protein_acc, is_reviewed)
 
-    cur.close()
-    con.close()
+        cur.close()
+        con.close()
+
+        runs.spill()
+        phase.rows += runs.rows
+    return runs.files
 
-    if cache:
-        fd, path = tempfile.mkstemp(dir=tmpdir)
-        file.dump(cache, fd)
-        cache.clear()
-        files.append(path)
 
-    file.write(files)
+def iter_base(base, dictionary, excluded):
+    """Yield the proteins of an earlier export as a sorted run, without excluded proteins"""
+    for acc in base:
+        proteins = [
+            (dictionary[protein_id], is_reviewed)
+            for protein_id, is_reviewed in base[acc]
+            if protein_id not in excluded
+        ]
+        if proteins:
+            yield acc, proteins
+
+
+def export(uri, pronto_uri, args):
+    
+    file = File(args.o)
+    dictionary = Dictionary(args.d)
+    dictionary.open()
+    tmpdir = f"{args.o}_tmp"
+    try:
+        shutil.rmtree(tmpdir)
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(tmpdir)
+
+    with profiler.phase("oracle fetch"):
+        max_upi, timestamp = get_snapshot(uri, args.a)
+    metadata = {
+        "analysis": args.a,
+        "max_upi": max_upi,
+        "timestamp": timestamp.isoformat()
+    }
+
+    compression = None if args.compression == "none" else args.compression
+    since = None
+    if args.base:
+        # Patch an earlier export: fetch changed proteins only, and keep the others
+        base = File(args.base)
+        base.open()
+        if base.metadata.get("analysis") != args.a:
+            sys.exit(f"Error: {args.base} is not an export of analysis {args.a}")
+        elif base.dictionary_path != os.path.abspath(args.d):
+            sys.exit(f"Error: {args.base} does not use the dictionary {args.d}")
+        elif os.path.abspath(args.base) == os.path.abspath(args.o):
+            sys.exit("Error: the base export cannot be overwritten")
+
+        since = (base.metadata["max_upi"], datetime.fromisoformat(base.metadata["timestamp"]))
+        with profiler.phase("oracle fetch"):
+            changed = get_changed_proteins(uri, *since)
+        # Proteins not in the dictionary are not in the base export either
+        excluded = set(dictionary.lookup(changed, add=False).values())
+
+    if args.partitions > 1:
+        # Each UPI range is fetched by its own process, on its own connection,
+        # and gets its share of the memory budget
+        budget = args.memory_budget // args.partitions if args.memory_budget else None
+        ranges = get_upi_ranges(max_upi, args.partitions)
+        # Spills happen in the workers: their time (and CPU) is part of this phase
+        with profiler.phase("oracle fetch"), multiprocessing.Pool(args.partitions) as pool:
+            results = pool.starmap(export_matches, [
+                (uri, args.a, tmpdir, low, high, args.arraysize, budget, compression, since)
+                for low, high in ranges
+            ])
+
+        files = [path for paths in results for path in paths]
+    else:
+        files = export_matches(uri, args.a, tmpdir, arraysize=args.arraysize,
+                               budget=args.memory_budget, compression=compression,
+                               since=since)
+
+    if args.base:
+        files.append(iter_base(base, dictionary, excluded))
+
+    # Rows sorted to assign identifiers (accession, signature number) are smaller than cached rows
+    run_size = args.memory_budget // Runs.ROW_SIZE if args.memory_budget else 5000000
+    file.write(files, dictionary, metadata=metadata, buffer_size=args.buffer_size,
+               tmpdir=tmpdir, run_size=run_size)
+    dictionary.close()
+    if args.base:
+        base.close()
+
     shutil.rmtree(tmpdir)
 
 def connect_pg(url):
@@ -278,26 +1470,241 @@ def get_integrated_with_otherdb(url):
     con.close()
     return integrated
 
+def get_pronto_release(pronto_url):
+    """Return a key identifying the Pronto release, and the versions of its databases"""
+    con = connect_pg(pronto_url)
+    cur = con.cursor()
+    cur.execute("SELECT name, version FROM database ORDER BY name")
+    versions = dict(cur.fetchall())
+    cur.close()
+    con.close()
+
+    digest = hashlib.sha1(json.dumps(versions, sort_keys=True).encode()).hexdigest()
+    return digest[:12], versions
+
+
+class ProntoCache:
+    """Local snapshot of the reference data used by find, list and diff.
+
+    The cache is an export of the reviewed proteins of non-PANTHER signatures
+    in Pronto. Its metadata hold reviewed fragments and the ENTRY2METHOD
+    mappings of PANTHER and other signatures. There is one file per Pronto
+    release. Proteins are stored with the identifiers of the exports'
+    dictionary, so that they are loaded without mapping accessions.
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory, dictionary):
+        if dictionary.path is None:
+            raise ValueError("the cache requires exports written with a protein dictionary")
+
+        self.directory = directory
+        self.dictionary = dictionary
+        self.file = None
+        self.integrated = {}
+        self.signatures = {}
+        self.fragments = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def other_db(self):
+        return {sign_acc: self.file[sign_acc].all for sign_acc in self.file}
+
+    def open(self, uri, pronto_uri, refresh=False):
+        release, versions = get_pronto_release(pronto_uri)
+        path = os.path.join(self.directory, f"pronto-{release}.cache")
+
+        if refresh or not self.is_valid(path):
+            if uri is None:
+                sys.exit("Error: environment variable INTERPRO_URL not defined, "
+                         "required to build the cached reference data")
+            self.build(path, uri, pronto_uri, versions)
+
+        self.file = File(path)
+        self.file.open()
+        metadata = self.file.metadata
+        self.integrated = metadata["integrated"]
+        self.signatures = metadata["signatures"]
+        self.fragments = set(metadata["fragments"])
+
+    def is_valid(self, path):
+        if not os.path.isfile(path):
+            return False
+
+        with File(path) as f:
+            f.open()
+            return (f.metadata.get("cache") == self.VERSION
+                    and f.dictionary_path == os.path.abspath(self.dictionary.path))
+
+    def build(self, path, uri, pronto_uri, versions):
+        integrated = get_integrated(uri)
+        other_db, signatures = replacements_otherdb(uri, pronto_uri)
+        fragments = get_fragments(pronto_uri)
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+
+        # New accessions are added to the dictionary, so identifiers remain valid.
+        # The dictionary is shared with exports: identifiers are assigned under its lock
+        with self.dictionary.locked():
+            # Fragments are mapped in a single pass over the dictionary
+            metadata = {
+                "cache": self.VERSION,
+                "versions": versions,
+                "integrated": integrated,
+                "signatures": signatures,
+                "fragments": sorted(self.dictionary.lookup(fragments).values())
+            }
+
+            run = (
+                (sign_acc, [(acc, True) for acc in other_db[sign_acc]])
+                for sign_acc in sorted(other_db)
+            )
+
+            File(tmp_path).write([run], self.dictionary, metadata=metadata, sketches=False)
+
+        os.replace(tmp_path, path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
 def list_deleted(url, pronto_url, args):
-    integrated = get_integrated(url)
+    with File(args.f1) as now, File(args.f2) as nxt, profiler.phase("reference data"):
+        if args.cache:
+            dictionary = open_releases(now, nxt)
+            with ProntoCache(args.cache, dictionary) as cache:
+                cache.open(url, pronto_url, args.refresh)
+                integrated = cache.integrated
+        else:
+            now.open()
+            nxt.open()
+            integrated = get_integrated(url)
 
-    with File(args.f1) as now, File(args.f2) as nxt:
-        now.open()
-        nxt.open()
         for s_acc in sorted(integrated.keys()):
             if s_acc in now and s_acc not in nxt:
                 print(f"{s_acc}\t{integrated[s_acc]}")
 
 
-def gen_flag(similarity, same_reviewed):
+def flag_name(similarity, same_reviewed):
     if similarity >= 0.9 and same_reviewed:
-        return f"substitute ({similarity*100:.0f}%)"
+        return "substitute"
     elif same_reviewed:
-        return f"candidate ({similarity*100:.0f}%)"
+        return "candidate"
+    else:
+        return None
+
+
+def gen_flag(similarity, same_reviewed):
+    name = flag_name(similarity, same_reviewed)
+    if name:
+        return f"{name} ({similarity*100:.0f}%)"
     else:
         return f"{similarity*100:.0f}%"
 
 
+def format_replacements(s_acc, e_acc, candidates):
+    """Return the lines of a deleted signature and its candidates, in the TSV output"""
+    if not candidates:
+        return f"{s_acc}\t{e_acc}\t-\t-\t-\n"
+
+    lines = []
+    for other_acc, other_entry, similarity, reviewed in candidates:
+        flag = gen_flag(similarity, reviewed)
+        if lines:
+            lines.append(f"\t\t{other_acc}\t{other_entry}\t{flag}\n")
+        else:
+            lines.append(f"{s_acc}\t{e_acc}\t{other_acc}\t{other_entry}\t{flag}\n")
+
+    return "".join(lines)
+
+
+def replacement_rows(s_acc, e_acc, candidates):
+    """Yield a row per candidate of a deleted signature, in the columnar output"""
+    if not candidates:
+        yield s_acc, e_acc, None, None, None, None, None
+
+    for other_acc, other_entry, similarity, reviewed in candidates:
+        yield (s_acc, e_acc, other_acc, other_entry or None, similarity, reviewed,
+               flag_name(similarity, reviewed))
+
+
+# Columns of the Parquet/Arrow output of find and diff, as (name, Arrow type)
+REPLACEMENT_COLUMNS = [
+    ("signature", "string"),
+    ("entry", "string"),
+    ("candidate", "string"),
+    ("candidate_entry", "string"),
+    ("similarity", "double"),
+    ("same_reviewed", "bool"),
+    ("flag", "string"),
+]
+SEQUENCE_COLUMNS = [
+    ("accession", "string"),
+    ("database", "string"),
+    ("status", "string"),
+]
+
+
+class TableWriter:
+    """Rows written in record batches to a Parquet or Arrow IPC file (requires pyarrow)"""
+
+    def __init__(self, path, columns, file_format, batch_size=65536):
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            import pyarrow.parquet
+        except ImportError:
+            sys.exit(f"Error: --format {file_format} requires pyarrow")
+
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([(name, pyarrow.type_for_alias(alias)) for name, alias in columns])
+        if file_format == "parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+        self.batch_size = batch_size
+        self.columns = [[] for _ in columns]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, row):
+        for column, value in zip(self.columns, row):
+            column.append(value)
+
+        if len(self.columns[0]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.columns[0]:
+            arrays = [
+                self.pa.array(column, type=field.type)
+                for column, field in zip(self.columns, self.schema)
+            ]
+            self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+            for column in self.columns:
+                column.clear()
+
+    def close(self):
+        if self.writer is not None:
+            self.flush()
+            self.writer.close()
+            self.writer = None
+
+
 def replacements_otherdb(url, pronto_url):
 
     con = cx_Oracle.connect(url)
@@ -341,139 +1748,918 @@ def replacements_otherdb(url, pronto_url):
     return replacement, signatures
 
 
+class ReplacementSearch:
+    """Score the candidate replacements of a deleted signature"""
+
+    def __init__(self, integrated, signatures, nxt_index, other_index):
+        self.integrated = integrated
+        self.signatures = signatures
+        self.nxt_index = nxt_index
+        self.other_index = other_index
+
+    def __call__(self, s_acc, reviewed):
+        """Return candidates as (accession, entry, similarity, same reviewed proteins),
+        sorted by descending similarity"""
+        m = re.fullmatch(r"(PTHR\d+):SF\d+", s_acc)
+        parent_acc = m.group(1) if m else None
+
+        candidates = []
+        for other_acc, size, common in self.nxt_index.search(reviewed, extra=parent_acc):
+            union = len(reviewed) + size - common
+            similarity = common / union
+
+            if other_acc == parent_acc or similarity >= MIN_SIMILARITY:
+                candidates.append((
+                    other_acc,
+                    self.integrated.get(other_acc, ''),
+                    similarity,
+                    common == len(reviewed) == size
+                ))
+
+        for sign_acc, size, common in self.other_index.search(reviewed):
+            union = len(reviewed) + size - common
+            similarity = common / union
+
+            if similarity >= MIN_SIMILARITY:
+                candidates.append((
+                    sign_acc,
+                    self.signatures.get(sign_acc, ''),
+                    similarity,
+                    common == len(reviewed) == size
+                ))
+
+        candidates.sort(key=lambda x: -x[2])
+        return candidates
+
+
+# Search state inherited by worker processes when they are forked
+_shared_search = None
+
+
+def search_shard(start, stop):
+    search, queries = _shared_search
+    return [search(s_acc, reviewed) for s_acc, reviewed in queries[start:stop]]
+
+
+def search_parallel(search, queries, workers):
+    """Search candidates in worker processes, yielding results in the order of `queries`.
+
+    Workers are forked after the indexes are built, so they share them
+    (copy-on-write) instead of receiving pickled copies.
+    """
+    global _shared_search
+    _shared_search = search, queries
+
+    # Several shards per worker, so that a slow shard does not hold the others
+    size = max(1, math.ceil(len(queries) / (workers * 8)))
+    shards = [(i, min(i + size, len(queries))) for i in range(0, len(queries), size)]
+
+    # Objects created so far are never collected: avoid copying their pages in workers
+    gc.freeze()
+    try:
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            for results in executor.map(search_shard, *zip(*shards)):
+                yield from results
+    finally:
+        gc.unfreeze()
+        _shared_search = None
+
+
+def input_stat(path):
+    """Identify an input file by its path, size and modification time"""
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime": st.st_mtime_ns}
+
+
+class CheckpointedOutput:
+    """Output file written in committed chunks of items.
+
+    The progress manifest (<path>.progress) records the number of items
+    and bytes committed, so an interrupted run can resume after the last
+    committed chunk. It also records the inputs (e.g. from input_stat()):
+    a run cannot resume from progress made on different inputs.
+    """
+
+    def __init__(self, path, inputs, chunk_size=1000):
+        self.path = path
+        self.manifest = f"{path}.progress"
+        self.inputs = inputs
+        self.chunk_size = chunk_size
+        self.fh = None
+        self.done = 0
+        self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(complete=exc_type is None)
+
+    def open(self, resume=False):
+        """Open the output file, and return the number of items already committed"""
+        self.done = 0
+        offset = 0
+        if resume and os.path.isfile(self.manifest):
+            with open(self.manifest, "rt") as fh:
+                progress = json.load(fh)
+
+            if progress["inputs"] != self.inputs:
+                raise ValueError(f"{self.manifest}: progress recorded for different inputs")
+
+            self.done = progress["done"]
+            offset = progress["offset"]
+
+        mode = "r+b" if offset else "wb"
+        self.fh = open(self.path, mode)
+        # Drop what was written after the last commit
+        self.fh.truncate(offset)
+        self.fh.seek(offset)
+        return self.done
+
+    def add(self, text):
+        """Write the lines of an item, committing them once a chunk is complete"""
+        self.fh.write(text.encode())
+        self.pending += 1
+        if self.pending >= self.chunk_size:
+            self.commit()
+
+    def commit(self, complete=False):
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.done += self.pending
+        self.pending = 0
+
+        tmp_path = f"{self.manifest}.tmp"
+        with open(tmp_path, "wt") as fh:
+            json.dump({
+                "inputs": self.inputs,
+                "done": self.done,
+                "offset": self.fh.tell(),
+                "complete": complete
+            }, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, self.manifest)
+
+    def close(self, complete=True):
+        if self.fh is not None:
+            if complete:
+                self.commit(complete=True)
+            self.fh.close()
+            self.fh = None
+
+
 def find_replacements(uri, pronto_uri, args):
-    fragments = get_fragments(pronto_uri)
     # integrated = get_integrated(uri)
     integrated = get_deleted_from_file(args.f3)
+    count = 0
+
+    with File(args.f1) as now, File(args.f2) as nxt, ExitStack() as stack:
+        dictionary = open_releases(now, nxt)
+
+        with profiler.phase("reference data"):
+            if args.cache:
+                cache = stack.enter_context(ProntoCache(args.cache, dictionary))
+                cache.open(uri, pronto_uri, args.refresh)
+                fragments = cache.fragments
+                other_db = cache.other_db
+                signatures = cache.signatures
+            else:
+                fragments = get_fragments(pronto_uri)
+                # entries_with_other_db = get_integrated_with_otherdb(uri)
+                other_db, signatures = replacements_otherdb(uri, pronto_uri)
+
+                # Map accessions from Pronto to identifiers in a single pass over the dictionary
+                accessions = set(fragments)
+                for other_proteins in other_db.values():
+                    accessions |= other_proteins
+
+                ids = dictionary.lookup(accessions)
+                fragments = {ids[acc] for acc in fragments}
+                other_db = {
+                    sign_acc: array("I", sorted(ids[acc] for acc in other_proteins))
+                    for sign_acc, other_proteins in other_db.items()
+                }
+
+        with profiler.phase("index load") as phase:
+            queries = []
+            for s_acc in sorted(integrated):
+                if s_acc not in now or s_acc in nxt:
+                    continue
 
-    # entries_with_other_db = get_integrated_with_otherdb(uri)
-    other_db, signatures = replacements_otherdb(uri, pronto_uri)
-    count = 0 
-
-    with File(args.f1) as now, File(args.f2, cached=True) as nxt:
-        now.open()
-        nxt.open()
-        for s_acc in sorted(integrated):
-            if s_acc not in now or s_acc in nxt:
-                continue            
-            
-            e_acc = integrated[s_acc]
-            proteins = now[s_acc]
-            
-            reviewed = proteins.reviewed.difference(fragments)
-            # print(s_acc, e_acc, reviewed)
-            
-            # if e_acc in entries_with_other_db:
-            #     print(f"{s_acc}\t{e_acc}\tintegrated with other signatures\t-\t-")
-            #     continue
+                proteins = now[s_acc]
+                queries.append((s_acc, exclude(proteins.reviewed, fragments)))
+
+            if args.format != "tsv":
+                if not args.output:
+                    sys.exit(f"Error: --format {args.format} requires --output")
+                elif args.resume:
+                    sys.exit("Error: --resume requires the TSV format")
+
+                table = stack.enter_context(TableWriter(args.output, REPLACEMENT_COLUMNS, args.format))
+
+                def write(s_acc, e_acc, candidates):
+                    for row in replacement_rows(s_acc, e_acc, candidates):
+                        table.add(row)
+            elif args.output:
+                # Results are committed by chunks of signatures: skip those of an interrupted run
+                inputs = {
+                    "f1": input_stat(args.f1),
+                    "f2": input_stat(args.f2),
+                    "f3": input_stat(args.f3),
+                    "approx": args.approx
+                }
+                output = stack.enter_context(CheckpointedOutput(args.output, inputs, args.chunk_size))
+                queries = queries[output.open(args.resume):]
+
+                def write(s_acc, e_acc, candidates):
+                    output.add(format_replacements(s_acc, e_acc, candidates))
+            else:
+                def write(s_acc, e_acc, candidates):
+                    sys.stdout.write(format_replacements(s_acc, e_acc, candidates))
 
-            m = re.fullmatch(r"(PTHR\d+):SF\d+", s_acc)
-            parent_acc = m.group(1) if m else None
+            if args.approx:
+                # Only read the proteins of candidates colliding with deleted signatures
+                @lru_cache(maxsize=1024)
+                def get_nxt_proteins(other_acc):
+                    return exclude(nxt[other_acc].all, fragments)
 
-            candidates = []
-            for other_acc in nxt:
-                other_proteins = nxt[other_acc]
-                op_reviewed = other_proteins.all.difference(fragments)
-                common = len(reviewed & op_reviewed)
-                if common == 0:
-                    continue
+                nxt_index = MinHashIndex(get_nxt_proteins)
+                for other_acc, sketch in sorted(nxt.sketches().items()):
+                    nxt_index.add(other_acc, sketch)
 
-                union = len(reviewed) + len(op_reviewed) - common
-                similarity = common / union
+                other_index = MinHashIndex(other_db.__getitem__)
+                for sign_acc, other_proteins in other_db.items():
+                    other_index.add(sign_acc, minhash(other_proteins))
 
-                if other_acc == parent_acc or similarity >= MIN_SIMILARITY:
-                    candidates.append((
-                        other_acc,
-                        integrated.get(other_acc, ''),
-                        similarity,
-                        reviewed and reviewed == op_reviewed
-                    ))
+                phase.rows += len(nxt) + len(other_db)
+            else:
+                # Only proteins of deleted signatures can contribute to a similarity
+                wanted = set()
+                for s_acc, reviewed in queries:
+                    wanted.update(reviewed)
+
+                # Read each signature of the next release once, instead of once per deleted signature
+                nxt_index = SimilarityJoin(wanted)
+                for other_acc in nxt:
+                    nxt_index.add(other_acc, exclude(nxt[other_acc].all, fragments))
+                nxt_index.build()
+
+                other_index = SimilarityJoin(wanted)
+                for sign_acc, other_proteins in other_db.items():
+                    other_index.add(sign_acc, other_proteins)
+                other_index.build()
+
+                phase.rows += sum(nxt_index.sizes) + sum(other_index.sizes)
+
+        search = ReplacementSearch(integrated, signatures, nxt_index, other_index)
+        if args.workers > 1:
+            results = search_parallel(search, queries, args.workers)
+        else:
+            results = (search(s_acc, reviewed) for s_acc, reviewed in queries)
+
+        # Candidates are scored as they are consumed: output is a nested phase
+        with profiler.phase("candidate scoring") as phase:
+            reported = set()
+            for (s_acc, reviewed), candidates in zip(queries, results):
+                e_acc = integrated[s_acc]
+                phase.rows += 1
+
+                if candidates:
+                    reported |= {(s_acc, c[0]) for c in candidates}
+                    count+=1
+
+                with profiler.phase("output"):
+                    write(s_acc, e_acc, candidates)
+
+                # if count >= 100:
+                #     break
+
+    if args.exact:
+        if args.output and args.format == "tsv":
+            # Include the candidates committed by interrupted runs
+            reported = load_replacement_pairs(args.output)
+
+        expected = load_replacement_pairs(args.exact)
+        found = len(expected & reported)
+        recall = found / len(expected) if expected else 1
+        sys.stderr.write(f"recall: {found}/{len(expected)} ({recall * 100:.1f}%)\n")
+
+class ExternalSort:
+    """Sort distinct string keys externally: runs of at most `run_size` keys
+    are sorted in memory, written to `tmpdir`, then merged."""
+
+    def __init__(self, tmpdir, run_size):
+        self.tmpdir = tmpdir
+        self.run_size = run_size
+        self.keys = set()
+        self.runs = []
+
+    def add(self, key):
+        self.keys.add(key)
+        if len(self.keys) >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        if self.keys:
+            with profiler.phase("spill") as phase:
+                self.runs.append(dump_run(self.keys, self.tmpdir))
+                phase.rows += len(self.keys)
+                self.keys.clear()
 
-            for sign_acc in other_db:
-                common = len(reviewed & other_db[sign_acc])
-                if common == 0:
-                    continue
+    def __iter__(self):
+        """Yield the sorted and distinct keys (runs are kept: keys can be iterated again)"""
+        self.spill()
+        files = [open(path, "rt", buffering=1024 * 1024) for path in self.runs]
+        try:
+            last = None
+            for line in heapq.merge(*files):
+                if line != last:
+                    yield line[:-1]
+                    last = line
+        finally:
+            for fh in files:
+                fh.close()
 
-                union = len(reviewed) + len(other_db[sign_acc]) - common
-                similarity = common / union
+    def close(self):
+        for path in self.runs:
+            os.remove(path)
+        self.runs = []
 
-                if similarity >= MIN_SIMILARITY:
-                    candidates.append((
-                        sign_acc,
-                        signatures.get(sign_acc, ''),
-                        similarity,
-                        reviewed and reviewed == other_db[sign_acc]
-                    ))
 
-            if not candidates:
-                print(f"{s_acc}\t{e_acc}\t-\t-\t-")
-                continue
+def protein_key(protein_id, reviewed, dictionary):
+    return f"{0 if reviewed else 1}\t{dictionary[protein_id]}"
 
-            candidates.sort(key=lambda x: -x[2])
 
-            other_acc, other_entry, similarity, reviewed = candidates[0]
-            flag = gen_flag(similarity, reviewed)
-            print(f"{s_acc}\t{e_acc}\t{other_acc}\t{other_entry}\t{flag}")
-            count+=1
+def sort_proteins(f, signatures, dictionary, tmpdir, run_size):
+    """Yield the proteins matched by signatures, as sorted and distinct
+    "<0|1>\t<accession>" keys (0 for reviewed proteins)."""
+    keys = ExternalSort(tmpdir, run_size)
+    for s_acc in signatures:
+        try:
+            proteins = f[s_acc]
+        except KeyError:
+            continue
 
-            for other_acc, other_entry, similarity, reviewed in candidates[1:]:
-                flag = gen_flag(similarity, reviewed)
-                print(f"\t\t{other_acc}\t{other_entry}\t{flag}")
+        for protein_id, reviewed in proteins:
+            keys.add(protein_key(protein_id, reviewed, dictionary))
 
-            # if count >= 100:
-            #     break
+    yield from keys
 
-def find_sequences(uri, pronto_uri, args):
-    integrated = get_integrated(uri)
 
-    rev_now = set()
-    unr_now = set()
-    with File(args.f1) as f:
-        f.open()
-        for s_acc in sorted(integrated.keys()):
-            try:
-                proteins = f[s_acc]
-            except KeyError:
-                continue
+def dump_run(keys, tmpdir):
+    fd, path = tempfile.mkstemp(dir=tmpdir)
+    with open(fd, "wt") as fh:
+        for key in sorted(keys):
+            fh.write(f"{key}\n")
+
+    return path
+
+
+def merge_join(old, new):
+    """Merge two sorted streams of distinct keys, yielding (key, in_old, in_new)"""
+    old_key = next(old, None)
+    new_key = next(new, None)
+    while old_key is not None or new_key is not None:
+        if new_key is None or (old_key is not None and old_key < new_key):
+            yield old_key, True, False
+            old_key = next(old, None)
+        elif old_key is None or new_key < old_key:
+            yield new_key, False, True
+            new_key = next(new, None)
+        else:
+            yield old_key, True, True
+            old_key = next(old, None)
+            new_key = next(new, None)
+
+
+def find_sequences(uri, pronto_uri, args):
+    if args.format != "tsv" and not args.output:
+        sys.exit(f"Error: --format {args.format} requires --output")
+
+    with File(args.f1) as now, File(args.f2) as nxt, ExitStack() as stack:
+        dictionary = open_releases(now, nxt)
+
+        if args.format != "tsv":
+            table = stack.enter_context(TableWriter(args.output, SEQUENCE_COLUMNS, args.format))
+            out = None
+        elif args.output:
+            out = stack.enter_context(open(args.output, "wt", buffering=1024 * 1024))
+        else:
+            out = sys.stdout
+
+        with profiler.phase("reference data"):
+            if args.cache:
+                with ProntoCache(args.cache, dictionary) as cache:
+                    cache.open(uri, pronto_uri, args.refresh)
+                    integrated = sorted(cache.integrated)
             else:
-                for acc, reviewed in proteins.data:
-                    if reviewed:
-                        rev_now.add(acc)
+                integrated = sorted(get_integrated(uri))
+
+        with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+            old = sort_proteins(now, integrated, dictionary, tmpdir, args.run_size)
+            new = sort_proteins(nxt, integrated, dictionary, tmpdir, args.run_size)
+
+            # Keys are sorted by status then accession: gained proteins are written
+            # as they come, lost proteins are written after
+            lost_path = os.path.join(tmpdir, "lost")
+            # Exports are read and sorted as keys are merged: spills are a nested phase
+            with open(lost_path, "wt") as lost, profiler.phase("merge join") as phase:
+                for key, in_old, in_new in merge_join(old, new):
+                    phase.rows += 1
+                    if in_old and in_new:
+                        continue
+
+                    status, acc = key.split("\t")
+                    database = "swissprot" if status == "0" else "trembl"
+                    if not in_new:
+                        lost.write(f"{acc}\t{database}\tlost\n")
+                    elif out is not None:
+                        out.write(f"{acc}\t{database}\tgained\n")
                     else:
-                        unr_now.add(acc)
+                        table.add((acc, database, "gained"))
 
-    rev_gained = []
-    unr_gained = []
-    with File(args.f2) as f:
-        f.open()
-        for s_acc in sorted(integrated.keys()):
-            try:
-                proteins = f[s_acc]
-            except KeyError:
-                continue
+            with profiler.phase("output"), open(lost_path, "rt") as fh:
+                if out is not None:
+                    shutil.copyfileobj(fh, out)
+                else:
+                    for line in fh:
+                        table.add(line.rstrip("\n").split("\t"))
+
+        dictionary.close()
+
+
+def best_replacement(index, reviewed):
+    """Return the most similar signature as (accession, similarity), or None"""
+    best = None
+    for other_acc, size, common in index.search(reviewed):
+        similarity = common / (len(reviewed) + size - common)
+        if similarity >= MIN_SIMILARITY and (best is None or similarity > best[1]):
+            best = other_acc, similarity
+
+    return best
+
+
+def trace_lineage(uri, pronto_uri, args):
+    names = [os.path.basename(path) for path in args.files]
+
+    with ExitStack() as stack:
+        files = [stack.enter_context(File(path)) for path in args.files]
+        dictionary = open_releases(*files)
+        stack.callback(dictionary.close)
+
+        with profiler.phase("reference data"):
+            if args.cache:
+                cache = stack.enter_context(ProntoCache(args.cache, dictionary))
+                cache.open(uri, pronto_uri, args.refresh)
+                integrated = cache.integrated
+                fragments = cache.fragments
             else:
-                for acc, reviewed in proteins.data:
-                    if reviewed:
-                        if acc in rev_now:
-                            rev_now.remove(acc)
+                integrated = get_integrated(uri)
+                fragments = get_fragments(pronto_uri)
+                ids = dictionary.lookup(fragments)
+                fragments = {ids[acc] for acc in fragments}
+
+        tmpdir = stack.enter_context(tempfile.TemporaryDirectory(dir=args.tmpdir))
+        seq_file = stack.enter_context(open(args.sequences, "wt")) if args.sequences else None
+
+        deleted = []    # for each step: signatures of the release absent from the next one
+        mappings = []   # for each step: {deleted signature: (replacement, similarity)}
+        queries = []
+        old = None
+        for i, f in enumerate(files):
+            nxt = files[i + 1] if i + 1 < len(files) else None
+
+            index = None
+            if queries:
+                wanted = set()
+                for s_acc, reviewed in queries:
+                    wanted.update(reviewed)
+                index = SimilarityJoin(wanted)
+
+            # Single pass over the release: index its signatures for the previous step,
+            # collect its deleted signatures for the next step,
+            # and sort the proteins of integrated signatures for both
+            keys = ExternalSort(tmpdir, args.run_size)
+            next_queries = []
+            with profiler.phase("index load") as phase:
+                for s_acc in f:
+                    proteins = f[s_acc]
+                    phase.rows += len(proteins)
+                    if index is not None:
+                        index.add(s_acc, exclude(proteins.all, fragments))
+                    if nxt is not None and s_acc not in nxt:
+                        next_queries.append((s_acc, exclude(proteins.reviewed, fragments)))
+                    if s_acc in integrated:
+                        for protein_id, reviewed in proteins:
+                            keys.add(protein_key(protein_id, reviewed, dictionary))
+
+                if index is not None:
+                    index.build()
+
+            if i > 0:
+                mapping = {}
+                if index is not None:
+                    with profiler.phase("candidate scoring") as phase:
+                        for s_acc, reviewed in queries:
+                            best = best_replacement(index, reviewed)
+                            if best is not None:
+                                mapping[s_acc] = best
+                        phase.rows += len(queries)
+
+                deleted.append([s_acc for s_acc, reviewed in queries])
+                mappings.append(mapping)
+
+                counts = {"gained": [0, 0], "lost": [0, 0]}
+                with profiler.phase("merge join") as phase:
+                    for key, in_old, in_new in merge_join(iter(old), iter(keys)):
+                        phase.rows += 1
+                        if in_old and in_new:
+                            continue
+
+                        status, acc = key.split("\t")
+                        change = "gained" if in_new else "lost"
+                        counts[change][int(status)] += 1
+                        if seq_file is not None:
+                            database = "swissprot" if status == "0" else "trembl"
+                            seq_file.write(f"{names[i - 1]}\t{names[i]}\t{acc}\t{database}\t{change}\n")
+
+                old.close()
+                sys.stderr.write(f"{names[i - 1]} -> {names[i]}: "
+                                 f"{len(queries)} deleted, {len(mapping)} replaced, "
+                                 f"swissprot +{counts['gained'][0]}/-{counts['lost'][0]}, "
+                                 f"trembl +{counts['gained'][1]}/-{counts['lost'][1]}\n")
+
+            old = keys
+            queries = next_queries
+
+        # Follow each deleted integrated signature to the last release
+        with profiler.phase("output"):
+            print("\t".join(["entry"] + names))
+            for step, accessions in enumerate(deleted):
+                for s_acc in accessions:
+                    if s_acc not in integrated:
+                        continue
+
+                    cells = [""] * len(files)
+                    cells[step] = s_acc
+                    acc = s_acc
+                    for j in range(step, len(files) - 1):
+                        if acc in files[j + 1]:
+                            cells[j + 1] = acc
+                        elif acc in mappings[j]:
+                            acc, similarity = mappings[j][acc]
+                            cells[j + 1] = f"{acc} ({similarity * 100:.0f}%)"
                         else:
-                            rev_gained.append(acc)
-                    elif acc in unr_now:
-                        unr_now.remove(acc)
-                    else:
-                        unr_gained.append(acc)
+                            cells[j + 1:] = ["-"] * (len(files) - j - 1)
+                            break
+
+                    print("\t".join([integrated[s_acc]] + cells))
 
-    for acc in sorted(rev_gained):
-        print(f"{acc}\tswissprot\tgained")
 
-    for acc in sorted(unr_gained):
-        print(f"{acc}\ttrembl\tgained")
+class ProteinIndex:
+    """Protein -> signatures index of an export (<export>.proteins sidecar).
 
-    for acc in sorted(rev_now):
-        print(f"{acc}\tswissprot\tlost")
+    Layout (native byte order):
+      - header: magic, version, number of accessions, number of protein
+        identifiers, number of postings, size and modification time of the export
+      - offsets: for each protein identifier, the position of its first posting
+      - postings: positions of signatures in the (sorted) index of the export
+      - accessions: fixed-width (accession, identifier) records, sorted by accession
 
-    for acc in sorted(unr_now):
-        print(f"{acc}\ttrembl\tlost")
+    The index is built once, then memory-mapped.
+    """
+
+    MAGIC = b"PTHRINV\0"
+    VERSION = 1
+    HEADER = struct.Struct("<8sIQQQQQ")
+    ACCESSION = struct.Struct(f"<{Dictionary.WIDTH + 2}sI")
+
+    def __init__(self, export):
+        self.export = export
+        self.path = f"{export.path}.proteins"
+        self.fh = None
+        self.mm = None
+        self.num_accessions = 0
+        self.offsets = None
+        self.postings = None
+        self.accessions_start = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def source(self):
+        st = os.stat(self.export.path)
+        return st.st_size, st.st_mtime_ns
+
+    def layout(self, num_ids, num_postings):
+        """Return the positions of offsets, postings and accessions"""
+        offsets_start = self.HEADER.size + -self.HEADER.size % 8
+        postings_start = offsets_start + (num_ids + 1) * 8
+        accessions_start = postings_start + num_postings * 4
+        accessions_start += -accessions_start % 8
+        return offsets_start, postings_start, accessions_start
+
+    def is_valid(self):
+        try:
+            with open(self.path, "rb") as fh:
+                header = fh.read(self.HEADER.size)
+        except FileNotFoundError:
+            return False
+
+        if len(header) < self.HEADER.size:
+            return False
+
+        magic, version, _, _, _, size, mtime = self.HEADER.unpack(header)
+        return magic == self.MAGIC and version == self.VERSION and (size, mtime) == self.source
+
+    def build(self, tmpdir=None, run_size=5000000):
+        """Invert the export: postings are counted, then filled in place in the mapped file"""
+        export = self.export
+        dictionary = export.dictionary
+        signatures = list(export)
+        num_ids = len(dictionary)
+        num_postings = sum(count for offset, count in export.footer.values())
+        offsets_start, postings_start, accessions_start = self.layout(num_ids, num_postings)
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w+b") as fh:
+            fh.truncate(accessions_start)
+            with mmap.mmap(fh.fileno(), accessions_start) as mm:
+                view = memoryview(mm)
+                offsets = view[offsets_start:postings_start].cast("Q")
+                postings = view[postings_start:postings_start + num_postings * 4].cast("I")
+
+                for acc in signatures:
+                    for protein_id in export[acc].ids:
+                        offsets[protein_id] += 1
+
+                # End of the postings of each identifier
+                total = 0
+                chunk = 1000000
+                for start in range(0, num_ids, chunk):
+                    stop = min(start + chunk, num_ids)
+                    ends = array("Q", accumulate(offsets[start:stop], initial=total))
+                    offsets[start:stop] = ends[1:]
+                    total = ends[-1]
+                offsets[num_ids] = total
+
+                # Filled backwards, so that postings are sorted and offsets end as starts
+                for i in range(len(signatures) - 1, -1, -1):
+                    for protein_id in export[signatures[i]].ids:
+                        offsets[protein_id] -= 1
+                        postings[offsets[protein_id]] = i
+
+                with tempfile.TemporaryDirectory(dir=tmpdir) as sort_dir:
+                    keys = ExternalSort(sort_dir, run_size)
+                    for protein_id in range(num_ids):
+                        if offsets[protein_id + 1] > offsets[protein_id]:
+                            keys.add(f"{dictionary[protein_id]}\t{protein_id}")
+
+                    num_accessions = 0
+                    fh.seek(accessions_start)
+                    for key in keys:
+                        acc, protein_id = key.split("\t")
+                        fh.write(self.ACCESSION.pack(acc.encode(), int(protein_id)))
+                        num_accessions += 1
+
+                del offsets, postings, view
+
+            fh.seek(0)
+            fh.write(self.HEADER.pack(self.MAGIC, self.VERSION, num_accessions, num_ids,
+                                      num_postings, *self.source))
+
+        os.replace(tmp_path, self.path)
+
+    def open(self):
+        self.close()
+        self.fh = open(self.path, "rb")
+        self.mm = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        _, _, self.num_accessions, num_ids, num_postings, _, _ = self.HEADER.unpack_from(self.mm)
+        offsets_start, postings_start, self.accessions_start = self.layout(num_ids, num_postings)
+
+        view = memoryview(self.mm)
+        self.offsets = view[offsets_start:postings_start].cast("Q")
+        self.postings = view[postings_start:postings_start + num_postings * 4].cast("I")
+
+    def close(self):
+        self.offsets = self.postings = None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def accession(self, i):
+        pos = self.accessions_start + i * self.ACCESSION.size
+        return self.mm[pos:pos + Dictionary.WIDTH + 2]
+
+    def lookup(self, acc):
+        """Return the identifier of a protein accession, or None if it has no match"""
+        record = acc.encode().ljust(Dictionary.WIDTH + 2, b"\0")
+        records = _Records(self)
+        i = bisect.bisect_left(records, record)
+        if i < self.num_accessions and records[i] == record:
+            pos = self.accessions_start + i * self.ACCESSION.size
+            return self.ACCESSION.unpack_from(self.mm, pos)[1]
+        return None
+
+    def __getitem__(self, protein_id):
+        """Return the positions of the signatures matching a protein"""
+        return self.postings[self.offsets[protein_id]:self.offsets[protein_id + 1]]
+
+
+class _Records:
+    """Sequence of the accession records of a ProteinIndex, for bisect"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.num_accessions
+
+    def __getitem__(self, i):
+        return self.index.accession(i)
+
+
+class LookupServer(ThreadingHTTPServer):
+    """JSON lookups over memory-mapped exports, with an LRU of decoded protein sets"""
+
+    daemon_threads = True
+
+    def __init__(self, address, releases, dictionary, cache_size=1024):
+        super().__init__(address, LookupHandler)
+        # {name: (export, protein index, signatures of the export)}
+        self.releases = releases
+        self.dictionary = dictionary
+        self.protein_sets = lru_cache(maxsize=cache_size)(self._protein_sets)
+
+    def _protein_sets(self, name, s_acc):
+        """Return (proteins, reviewed proteins) of a signature, as sets of identifiers"""
+        proteins = self.releases[name][0][s_acc]
+        return frozenset(proteins.all), frozenset(proteins.reviewed)
+
+    def select(self, query):
+        names = query.get("release")
+        if not names:
+            return list(self.releases)
+
+        unknown = [name for name in names if name not in self.releases]
+        if unknown:
+            raise LookupError(f"unknown release: {', '.join(unknown)}")
+        return names
+
+    def signature(self, s_acc, query):
+        show = query.get("accessions", ["none"])[0]
+        results = {}
+        for name in self.select(query):
+            if s_acc not in self.releases[name][0]:
+                continue
+
+            proteins, reviewed = self.protein_sets(name, s_acc)
+            result = {"proteins": len(proteins), "reviewed": len(reviewed)}
+            if show in ("all", "reviewed"):
+                ids = proteins if show == "all" else reviewed
+                result["accessions"] = sorted(self.dictionary[i] for i in ids)
+            results[name] = result
+
+        if not results:
+            raise LookupError(f"signature not found: {s_acc}")
+        return {"signature": s_acc, "releases": results}
+
+    def protein(self, p_acc, query):
+        results = {}
+        for name in self.select(query):
+            export, index, signatures = self.releases[name]
+            protein_id = index.lookup(p_acc)
+            if protein_id is not None:
+                results[name] = [signatures[i] for i in index[protein_id]]
+
+        if not results:
+            raise LookupError(f"protein not found: {p_acc}")
+        return {"protein": p_acc, "releases": results}
+
+    def jaccard(self, query):
+        try:
+            a, = query["a"]
+            b, = query["b"]
+        except (KeyError, ValueError):
+            raise ValueError("parameters 'a' and 'b' are required")
+
+        results = {}
+        for name in self.select(query):
+            export = self.releases[name][0]
+            if a not in export or b not in export:
+                continue
+
+            result = {}
+            for key, set_a, set_b in zip(("proteins", "reviewed"),
+                                          self.protein_sets(name, a),
+                                          self.protein_sets(name, b)):
+                common = len(set_a & set_b)
+                union = len(set_a) + len(set_b) - common
+                result[key] = {
+                    "common": common,
+                    "union": union,
+                    "jaccard": common / union if union else 0
+                }
+            results[name] = result
+
+        if not results:
+            raise LookupError(f"no release with both {a} and {b}")
+        return {"a": a, "b": b, "releases": results}
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    """Routes:
+      /releases
+      /signature/<accession>[?release=NAME][&accessions=all|reviewed]
+      /protein/<accession>[?release=NAME]
+      /jaccard?a=<accession>&b=<accession>[&release=NAME]
+    """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        query = parse_qs(url.query)
+
+        try:
+            if parts == ["releases"]:
+                result = {"releases": list(self.server.releases)}
+            elif len(parts) == 2 and parts[0] == "signature":
+                result = self.server.signature(parts[1], query)
+            elif len(parts) == 2 and parts[0] == "protein":
+                result = self.server.protein(parts[1], query)
+            elif parts == ["jaccard"]:
+                result = self.server.jaccard(query)
+            else:
+                raise LookupError(f"not found: {url.path}")
+        except LookupError as exc:
+            self.send_json(404, {"error": str(exc)})
+        except ValueError as exc:
+            self.send_json(400, {"error": str(exc)})
+        else:
+            self.send_json(200, result)
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(uri, pronto_uri, args):
+    with ExitStack() as stack:
+        files = [stack.enter_context(File(path)) for path in args.files]
+        dictionary = open_releases(*files)
+        stack.callback(dictionary.close)
+
+        releases = {}
+        for f in files:
+            name = os.path.basename(f.path)
+            if f.mm is None:
+                sys.exit(f"Error: {f.path} is in the former format: export it again")
+            elif name in releases:
+                sys.exit(f"Error: several exports named {name}")
+
+            index = stack.enter_context(ProteinIndex(f))
+            if not index.is_valid():
+                sys.stderr.write(f"building protein index of {f.path}\n")
+                with profiler.phase("index build"):
+                    index.build(args.tmpdir)
+            index.open()
+            releases[name] = (f, index, list(f))
+
+        server = LookupServer((args.host, args.port), releases, dictionary, args.cache_size)
+        stack.callback(server.server_close)
+        sys.stderr.write(f"serving {', '.join(releases)} on http://{args.host}:{args.port}\n")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", action="store_true",
+                        help="report wall time, CPU time, rows/s and peak RSS of each phase")
+    parser.add_argument("--profile-json", metavar="FILE",
+                        help="also write the profile to this JSON file (implies --profile)")
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache", metavar="DIR",
+                        help="directory of cached Pronto reference data, reused for the same Pronto release")
+    parser.add_argument("--refresh", action="store_true",
+                        help="rebuild the cached reference data")
 
 
 def main():
@@ -483,36 +2669,107 @@ def main():
     parser_exp = subparsers.add_parser("export", help="export files")
     parser_exp.add_argument("-a", help="analysis ID", type=int, required=True)
     parser_exp.add_argument("-o", help="output file", required=True)
-    parser_exp.set_defaults(func=export)
+    parser_exp.add_argument("-d", help="protein dictionary, shared by exports to compare", required=True)
+    parser_exp.add_argument("-p", "--partitions", type=int, default=1,
+                            help="number of UPI ranges exported in parallel (default: 1)")
+    parser_exp.add_argument("--arraysize", type=int, default=10000,
+                            help="number of rows fetched per round-trip (default: 10000)")
+    parser_exp.add_argument("--memory-budget", type=parse_size,
+                            help="spill rows to disk when their estimated size reaches "
+                                 "this budget, e.g. 2G (default: every 1e6 rows)")
+    parser_exp.add_argument("--compression", choices=["none", "zlib", "lzma"], default="zlib",
+                            help="compression of temporary runs (default: zlib)")
+    parser_exp.add_argument("--buffer-size", type=parse_size, default=1024 * 1024,
+                            help="read buffer per temporary run when merging (default: 1M)")
+    parser_exp.add_argument("--base", metavar="FILE",
+                            help="earlier export of the same analysis: only fetch proteins changed since")
+    add_profile_arguments(parser_exp)
+    parser_exp.set_defaults(func=export, env=["INTERPRO_URL"])
 
     parser_del = subparsers.add_parser("list", help="list deleted signatures")
     parser_del.add_argument("-1", dest="f1", help="current version file", required=True)
     parser_del.add_argument("-2", dest="f2", help="next version file", required=True)
-    parser_del.set_defaults(func=list_deleted)
+    add_cache_arguments(parser_del)
+    add_profile_arguments(parser_del)
+    parser_del.set_defaults(func=list_deleted, env=["INTERPRO_URL", "PRONTO_URL"])
 
     parser_rep = subparsers.add_parser("find", help="find replacements for deleted signatures")
     parser_rep.add_argument("-1", dest="f1", help="current version file", required=True)
     parser_rep.add_argument("-2", dest="f2", help="next version file", required=True)
     parser_rep.add_argument("-3", dest="f3", help="deleted signatures file", required=True)
-    parser_rep.set_defaults(func=find_replacements)
+    parser_rep.add_argument("--approx", action="store_true",
+                            help="search candidates with MinHash/LSH, then verify them")
+    parser_rep.add_argument("--exact", metavar="FILE",
+                            help="output of an exact run, to report the recall of candidates")
+    parser_rep.add_argument("--workers", type=int, default=1,
+                            help="number of worker processes (default: 1)")
+    parser_rep.add_argument("-o", "--output", metavar="FILE",
+                            help="output file, TSV written in committed chunks (default: stdout)")
+    parser_rep.add_argument("--format", choices=["tsv", "parquet", "arrow"], default="tsv",
+                            help="output format: Parquet and Arrow IPC have a row per candidate, "
+                                 "and require pyarrow (default: tsv)")
+    parser_rep.add_argument("--chunk-size", type=int, default=1000,
+                            help="number of signatures per committed chunk (default: 1000)")
+    parser_rep.add_argument("--resume", action="store_true",
+                            help="resume an interrupted run writing to the same output file")
+    add_cache_arguments(parser_rep)
+    add_profile_arguments(parser_rep)
+    parser_rep.set_defaults(func=find_replacements, env=["INTERPRO_URL", "PRONTO_URL"])
 
     parser_rep = subparsers.add_parser("diff", help="find gained/lost sequences")
     parser_rep.add_argument("-1", dest="f1", help="current version file", required=True)
     parser_rep.add_argument("-2", dest="f2", help="next version file", required=True)
-    parser_rep.set_defaults(func=find_sequences)
+    parser_rep.add_argument("-o", "--output", metavar="FILE", help="output file (default: stdout)")
+    parser_rep.add_argument("--format", choices=["tsv", "parquet", "arrow"], default="tsv",
+                            help="output format, Parquet and Arrow IPC require pyarrow (default: tsv)")
+    parser_rep.add_argument("--tmpdir", help="directory for temporary files (default: system default)")
+    parser_rep.add_argument("--run-size", type=int, default=5000000,
+                            help="maximum number of proteins sorted in memory (default: 5000000)")
+    add_cache_arguments(parser_rep)
+    add_profile_arguments(parser_rep)
+    parser_rep.set_defaults(func=find_sequences, env=["INTERPRO_URL", "PRONTO_URL"])
+
+    parser_lin = subparsers.add_parser("lineage", help="trace deleted signatures across several versions")
+    parser_lin.add_argument("files", nargs="+", metavar="FILE", help="version files, oldest first")
+    parser_lin.add_argument("--sequences", metavar="FILE",
+                            help="write the gained/lost proteins of each step to this file")
+    parser_lin.add_argument("--tmpdir", help="directory for temporary files (default: system default)")
+    parser_lin.add_argument("--run-size", type=int, default=5000000,
+                            help="maximum number of proteins sorted in memory (default: 5000000)")
+    add_cache_arguments(parser_lin)
+    add_profile_arguments(parser_lin)
+    parser_lin.set_defaults(func=trace_lineage, env=["INTERPRO_URL", "PRONTO_URL"])
+
+    parser_srv = subparsers.add_parser("serve", help="answer lookups over exports (HTTP/JSON)")
+    parser_srv.add_argument("files", nargs="+", metavar="FILE", help="version files")
+    parser_srv.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser_srv.add_argument("--port", type=int, default=8000, help="port to listen on (default: 8000)")
+    parser_srv.add_argument("--cache-size", type=int, default=1024,
+                            help="number of decoded protein sets kept in memory (default: 1024)")
+    parser_srv.add_argument("--tmpdir", help="directory for temporary files (default: system default)")
+    add_profile_arguments(parser_srv)
+    parser_srv.set_defaults(func=serve, env=[])
 
     args = parser.parse_args()
-
-    try:
-        uri = os.environ["INTERPRO_URL"]
-    except KeyError:
-        parser.error("Environment variable INTERPRO_URL not defined")
-    try:
-        pronto_uri = os.environ["PRONTO_URL"]
-    except KeyError:
-        parser.error("Environment variable PRONTO_URL not defined")
-    print(args.func)
-#    args.func(uri, pronto_uri, args)
+    if not hasattr(args, "func"):
+        parser.error("a command is required")
+    elif args.func is find_replacements and args.resume and not args.output:
+        parser.error("--resume requires -o/--output")
+    if getattr(args, "profile", False) or getattr(args, "profile_json", None):
+        args.func = profiled(args.func, args.profile_json)
+
+    # Only the connection strings a command uses are required. With cached reference
+    # data, InterPro is only queried to build the cache (checked by ProntoCache).
+    required = list(args.env)
+    if getattr(args, "cache", None) and not args.refresh:
+        required.remove("INTERPRO_URL")
+    for name in required:
+        if name not in os.environ:
+            parser.error(f"Environment variable {name} not defined")
+
+    uri = os.environ.get("INTERPRO_URL")
+    pronto_uri = os.environ.get("PRONTO_URL")
+    args.func(uri, pronto_uri, args)
 
 
 if __name__ == '__main__':
@@ -1,12 +1,21 @@
 import cx_Oracle
 import traceback
-import sys, errno, re, json, ssl, os
-from urllib import request
-from urllib.error import HTTPError
-from time import sleep
+import os
 import argparse
 from configparser import ConfigParser
 from multiprocessing import Pool
+from ebi_api import api_client, cache_from_config
+
+# InterPro API client of each pool process (see init_client)
+client = None
+
+def init_client(config_file):
+    # pool processes can be spawned (re-importing this module): each creates its own client
+    global client
+    config = ConfigParser()
+    config.read(config_file)
+    # each of the 10 processes sends at most one request per second, responses are cached
+    client = api_client(workers=1, rate=1, cache=cache_from_config(config))
 
 def db_connection(uri: str):
     try:
@@ -49,43 +58,13 @@ def get_pfam_ida(accession: str):
 
     total_nb_prot = get_total_protein_count(accession)
 
-    #disable SSL verification to avoid config issues
-    context = ssl._create_unverified_context()
-
     next = url
-  
-    attempts = 0
     while next:
-        try:
-            req = request.Request(next, headers={"Accept": "application/json"})
-            res = request.urlopen(req, context=context)
-            # If the API times out due a long running query
-            if res.status == 408:
-                # wait just over a minute
-                sleep(61)
-                # then continue this loop with the same URL
-                continue
-            elif res.status == 204:
-                #no data so leave loop
-                break
-            payload = json.loads(res.read().decode())
-            next = payload["next"]
-            attempts = 0
-            if not next:
-                last_page = True
-        except HTTPError as e:
-            if e.code == 408:
-                sleep(61)
-                continue
-            else:
-            # If there is a different HTTP error, it wil re-try 3 times before failing
-                if attempts < 3:
-                    attempts += 1
-                    sleep(61)
-                    continue
-                else:
-                    sys.stderr.write("LAST URL: " + next)
-                    raise e
+        payload = client.get_json(next)
+        if payload is None:
+            #no data so leave loop
+            break
+        next = payload["next"]
 
         for i, item in enumerate(payload["results"]):
             protein_count = item["unique_proteins"]
@@ -98,55 +77,14 @@ def get_pfam_ida(accession: str):
                 dom_length = end_dom-start_dom
                 if dom_length < prot_length/2: #pfam should cover at least 1/2 protein length
                     return domains, protein_count, total_nb_prot, protein, dom_length, prot_length
-        
-        # Don't overload the server, give it time before asking for more
-        if next:
-            sleep(1)
 
     return None
 
 def get_total_protein_count(accession):
     url=f"https://www.ebi.ac.uk/interpro/api/protein/entry/pfam/{accession}"
 
-    #disable SSL verification to avoid config issues
-    context = ssl._create_unverified_context()
-
-    next = url
-  
-    attempts = 0
-    while next:
-        try:
-            req = request.Request(next, headers={"Accept": "application/json"})
-            res = request.urlopen(req, context=context)
-            # If the API times out due a long running query
-            if res.status == 408:
-                # wait just over a minute
-                sleep(61)
-                # then continue this loop with the same URL
-                continue
-            elif res.status == 204:
-                #no data so leave loop
-                break
-            payload = json.loads(res.read().decode())
-            next = ""
-            attempts = 0
-            if not next:
-                last_page = True
-        except HTTPError as e:
-            if e.code == 408:
-                sleep(61)
-                continue
-            else:
-            # If there is a different HTTP error, it wil re-try 3 times before failing
-                if attempts < 3:
-                    attempts += 1
-                    sleep(61)
-                    continue
-                else:
-                    sys.stderr.write("LAST URL: " + next)
-                    raise e
-
-        count = (payload["proteins"]["uniprot"])
+    payload = client.get_json(url)
+    count = (payload["proteins"]["uniprot"])
     
     return count
         
@@ -170,7 +108,7 @@ if __name__ == "__main__":
 
     accessions = get_pfam_not_domain(uri)
 
-    with Pool(10) as p:
+    with Pool(10, initializer=init_client, initargs=(args.config,)) as p:
         results = p.map(get_pfam_ida, accessions)
 
     for item in results:
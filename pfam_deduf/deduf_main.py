@@ -10,106 +10,181 @@
                         2)search for DUF in literature
                         3)search GO term/keywords in Swissprot matches
                         4)search predicted structures
+                        all)all of the above (default)
+           [--force STEP]: re-run steps even if their inputs have not changed
+
+Steps run as a pipeline: an option also runs the steps it depends on, independent steps
+run in parallel, and steps whose inputs have not changed since the last run are skipped.
 
 """
 
 import argparse
 import os
+import sys
+import json
 from configparser import ConfigParser
 
+from deduf_utils import pfam_duf
 from search_swissprot import pfam_swiss
 from search_literature import pfam_litterature
 from search_go_keywords import pfam_go
 from search_models import pfam_model
+from ebi_api import api_client, cache_from_config
+from deduf_pipeline import pipeline
 
-if __name__ == "__main__":
-
-    parser = argparse.ArgumentParser()
-    parser.add_argument("config", metavar="FILE", help="configuration file")
-
-    parser.add_argument(
-        "-o",
-        "--option",
-        help="specify option to run 1)search swissprot names for unintegrated pfam DUF  2)search for DUF in literature 3)search GO terms/keywords in SwissProt 4)search predicted structures",
-        required=True,
-        default=[1, 2, 3, 4],
-    )
-
-    args = parser.parse_args()
-
-    if not os.path.isfile(args.config):
-        parser.error(f"Cannot open '{args.config}': " f"no such file or directory")
+# steps run for each option (with the steps they depend on)
+OPTIONS = {"1": ["swissprot"], "2": ["literature"], "3": ["go_keywords"], "4": ["models"], "all": None}
 
-    config = ConfigParser()
-    config.read(args.config)
 
+def build_pipeline(config, source, refresh=False):
     outputdir = config["dir"]["outputdir"]
+    model_dir = config["dir"]["modeldir"]
+
+    # intermediate files, shared by the steps
+    dufs_json = os.path.join(outputdir, "duf_list.json")
+    release_json = os.path.join(outputdir, "duf_release.json")
+    ipr_json = os.path.join(outputdir, "duf_interpro_domains.json")
+    swiss_json = os.path.join(outputdir, "duf_swiss_accessions.json")
+    models_json = os.path.join(outputdir, "duf_models.json")
+    # results
     outfile = os.path.join(outputdir, "list_duf.csv")
     outfileipr = os.path.join(outputdir, "list_duf_with_ipr_name.csv")
     outputswiss = os.path.join(outputdir, "duf_swiss_names.tsv")
-    model_dir = config["dir"]["modeldir"]
+    outputlit = os.path.join(outputdir, "duf_litterature.csv")
+    outputgo = os.path.join(outputdir, "duf_go_keywords.tsv")
 
     # database connection values
     user = config["database"]["user"]
     password = config["database"]["password"]
     schema = config["database"]["schema"]
-
-    print(args.option)
-    if args.option == "1":
-        print("Searching for SwissProt names")
-        # initialising
-        pfam_pip = pfam_swiss()
+    pronto = config.get("database", "pronto", fallback="")
+
+    # web services requests
+    workers = config.getint("api", "workers", fallback=8)
+    rate = config.getfloat("api", "rate", fallback=10)
+    # responses are cached, so that re-running an option (or a crashed run) is served locally
+    cache = cache_from_config(config, os.path.join(outputdir, "http_cache.sqlite"))
+    # all the services are on www.ebi.ac.uk: steps running in parallel share one client,
+    # so that the rate limit is global
+    client = api_client(workers=workers, rate=rate, cache=cache)
+
+    def duf_list():
+        pfam_pip = pfam_duf()
         pfam_pip.getConnection(user, password, schema)
-
-        pfam_pip.get_pfam_duf_list()
+        # the DUF list is only queried once per database release
+        release, versions = pfam_pip.get_pfam_duf_list_snapshot(outputdir, refresh)
         # pfam_pip.get_pfam_duf_list_unintegrated()
         pfam_pip.close_connection()
-
-        pfam_pip.get_list_swissprot_names()
+        pfam_pip.save_duf_list(dufs_json)
+        # the release is an output of the step, so that the steps depending on it
+        # are run again on a new release, even if the DUF list is unchanged
+        with open(release_json, "w") as outf:
+            json.dump({"release": release, "versions": versions}, outf, indent=1, sort_keys=True)
+
+    def interpro_domains():
+        pfam_pip = pfam_duf()
+        pfam_pip.load_duf_list(dufs_json)
+        pfam_pip.getConnection(user, password, schema)
         pfam_pip.get_nb_domain_per_interpro()
-        pfam_pip.get_go_annotation()
-
+        pfam_pip.close_connection()
+        pfam_pip.save_nb_domain_per_interpro(ipr_json)
         pfam_pip.save_duf_list_in_file(outfile, outfileipr)
 
+    def swissprot():
+        print("Searching for SwissProt names")
+        pfam_pip = pfam_swiss(client=client)
+        pfam_pip.load_duf_list(dufs_json)
+        pfam_pip.load_nb_domain_per_interpro(ipr_json)
+        if source == "pronto":
+            pfam_pip.get_list_swissprot_names_pronto(pronto)
+        else:
+            pfam_pip.get_list_swissprot_names()
         pfam_pip.save_swissprot_in_file(outputswiss)
+        pfam_pip.save_swissprot_accessions(swiss_json)
 
-    elif args.option == "2":
+    def literature():
         print("Searching DUF in literature")
-        pfam_pip = pfam_litterature()
-        pfam_pip.getConnection(user, password, schema)
-        pfam_pip.get_pfam_duf_list()
-        pfam_pip.close_connection()
+        pfam_pip = pfam_litterature(client=client)
+        pfam_pip.load_duf_list(dufs_json)
+        pfam_pip.get_list_articles()
+        pfam_pip.save_result_in_file(outputlit)
 
-        pfam_pip.save_duf_list_in_file(outfile, outfileipr)
+    def go_keywords():
+        print("Searching for GO and Keywords annotations in SwissProt entries")
+        pfam_pip = pfam_go(client=client)
+        pfam_pip.get_list_duf_from_file(outputswiss)
+        pfam_pip.load_swissprot_accessions(swiss_json)
+        pfam_pip.get_go_annotation()
+        pfam_pip.save_results_in_file(outputgo)
 
-        for pfamid in pfam_pip.list_duf:
-            print(pfamid)
-            pfam_pip.get_list_articles_duf(pfamid)
-            pfam_pip.get_list_articles_pfamid(pfamid)
+    def models():
+        print("Searching for predicted structures ")
+        pfam_pip = pfam_model(model_dir)
+        pfam_pip.load_duf_list(dufs_json)
+        count_in_model, count_not_in_model = pfam_pip.search_model_families()
+        with open(models_json, "w") as outf:
+            json.dump({"in_model": count_in_model, "not_in_model": count_not_in_model}, outf)
+
+    model_files = sorted(os.listdir(model_dir)) if os.path.isdir(model_dir) else []
+
+    steps = pipeline(os.path.join(outputdir, "deduf_pipeline.json"))
+    # the database release is checked at every run, later steps are skipped if the DUF list and the release are unchanged
+    steps.add_step("duf_list", duf_list, [dufs_json, release_json], always=True)
+    steps.add_step("interpro_domains", interpro_domains, [ipr_json, outfile, outfileipr], ["duf_list"])
+    steps.add_step(
+        "swissprot", swissprot, [outputswiss, swiss_json], ["duf_list", "interpro_domains"], {"source": source}
+    )
+    steps.add_step("literature", literature, [outputlit], ["duf_list"])
+    steps.add_step("go_keywords", go_keywords, [outputgo], ["duf_list", "swissprot"])
+    steps.add_step("models", models, [models_json], ["duf_list"], {"modeldir": model_dir, "models": model_files})
+    return steps
 
-        outputfile = os.path.join(outputdir, "duf_litterature.csv")
-        pfam_pip.save_result_in_file(outputfile)
 
-    elif args.option == "3":
-        print("Searching for GO and Keywords annotations in SwissProt entries")
-        pfam_pip = pfam_go()
-        try:
-            pfam_pip.get_list_duf_from_file(outputswiss)
-            pfam_pip.get_swissprot_accessions()
-            pfam_pip.get_go_annotation()
+if __name__ == "__main__":
 
-            outputfile = os.path.join(outputdir, "duf_go_keywords.tsv")
-            pfam_pip.save_results_in_file(outputfile)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config", metavar="FILE", help="configuration file")
 
-        except FileNotFoundError:
-            print(f"Error file {outputswiss} not found, run option 1 first")
+    parser.add_argument(
+        "-o",
+        "--option",
+        help="specify option to run 1)search swissprot names for unintegrated pfam DUF  2)search for DUF in literature 3)search GO terms/keywords in SwissProt 4)search predicted structures all)all of them (default)",
+        choices=list(OPTIONS),
+        default="all",
+    )
+    parser.add_argument(
+        "--source",
+        choices=["api", "pronto"],
+        default="api",
+        help="source of SwissProt matches for options 1 and 3: InterPro API (default) or Pronto database ([database] pronto in config)",
+    )
+    parser.add_argument(
+        "--force",
+        nargs="+",
+        metavar="STEP",
+        default=[],
+        help="re-run steps even if their inputs have not changed: duf_list, interpro_domains, swissprot, literature, go_keywords, models or all",
+    )
 
-    elif args.option == "4":
-        print("Searching for predicted structures ")
-        pfam_pip = pfam_model(model_dir)
-        pfam_pip.getConnection(user, password, schema)
-        pfam_pip.get_pfam_duf_list()
-        pfam_pip.close_connection()
+    args = parser.parse_args()
 
-        pfam_pip.search_model_families()
+    if not os.path.isfile(args.config):
+        parser.error(f"Cannot open '{args.config}': " f"no such file or directory")
+
+    config = ConfigParser()
+    config.read(args.config)
 
+    if args.source == "pronto" and not config.get("database", "pronto", fallback=""):
+        parser.error("--source pronto requires a pronto connection string in the configuration file")
+
+    # forcing the DUF list step also refreshes the snapshot of the current release
+    refresh = "duf_list" in args.force or "all" in args.force
+    steps = build_pipeline(config, args.source, refresh)
+    for name in args.force:
+        if name != "all" and name not in steps.steps:
+            parser.error(f"--force: unknown step '{name}'")
+
+    print(args.option)
+    failed = steps.run(OPTIONS[args.option], args.force)
+    if failed:
+        sys.exit(f"Failed steps: {', '.join(failed)}")
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os, json, hashlib, traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import time
+
+
+class pipeline:
+    def __init__(self, manifest, workers=4):
+        """
+		Run steps as a dependency graph, steps without pending dependencies run in parallel.
+
+		The outputs of each step are recorded in the manifest with their digest, with a
+		fingerprint of the step parameters and of the outputs of its dependencies.
+		A step is skipped if its fingerprint is unchanged and its outputs are untouched.
+		"""
+        self.manifest_path = manifest
+        self.workers = workers
+        self.steps = dict()
+
+        try:
+            with open(manifest, "r") as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = dict()
+
+    def add_step(self, name, func, outputs, inputs=(), params=None, always=False):
+        """
+		func: called without arguments, writes the output files
+		outputs: list of files written by the step
+		inputs: names of the steps it depends on
+		params: JSON-serialisable values the outputs depend on
+		always: run even if unchanged (the step reads data the pipeline cannot fingerprint)
+		"""
+        for dependency in inputs:
+            if dependency not in self.steps:
+                raise ValueError(f"step '{name}' depends on unknown step '{dependency}'")
+
+        self.steps[name] = {
+            "func": func,
+            "outputs": list(outputs),
+            "inputs": list(inputs),
+            "params": params,
+            "always": always,
+        }
+
+    def get_fingerprint(self, name):
+        step = self.steps[name]
+        content = {
+            "params": step["params"],
+            "inputs": {dependency: self.manifest[dependency]["outputs"] for dependency in step["inputs"]},
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def get_digest(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def is_up_to_date(self, name, fingerprint):
+        done = self.manifest.get(name)
+        if done is None or done["fingerprint"] != fingerprint:
+            return False
+
+        for path, digest in done["outputs"].items():
+            if not os.path.isfile(path) or self.get_digest(path) != digest:
+                return False
+        return True
+
+    def get_targets(self, targets):
+        # requested steps and all the steps they depend on
+        selected = set()
+        pending = list(targets or self.steps)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.steps[name]["inputs"])
+        return [name for name in self.steps if name in selected]
+
+    def save_manifest(self):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def run(self, targets=None, force=()):
+        """
+		Run the targets (default: all steps) and the steps they depend on.
+		Steps in `force` are run even if unchanged, "all" forces every step.
+		Return the list of failed steps
+		"""
+        todo = self.get_targets(targets)
+        done = set()
+        failed = []
+        running = dict()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while todo or running:
+                for name in list(todo):
+                    step = self.steps[name]
+                    if any(dependency in failed for dependency in step["inputs"]):
+                        print(f"[{name}] not run, a dependency failed")
+                        todo.remove(name)
+                        failed.append(name)
+                    elif all(dependency in done for dependency in step["inputs"]):
+                        todo.remove(name)
+                        fingerprint = self.get_fingerprint(name)
+                        forced = step["always"] or name in force or "all" in force
+                        if not forced and self.is_up_to_date(name, fingerprint):
+                            print(f"[{name}] unchanged, skipped")
+                            done.add(name)
+                        else:
+                            print(f"[{name}] started")
+                            running[executor.submit(step["func"])] = (name, fingerprint, time())
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, fingerprint, start = running.pop(future)
+                    try:
+                        future.result()
+                        outputs = {path: self.get_digest(path) for path in self.steps[name]["outputs"]}
+                    except Exception:
+                        print(f"[{name}] failed")
+                        traceback.print_exc()
+                        failed.append(name)
+                        continue
+
+                    self.manifest[name] = {"fingerprint": fingerprint, "outputs": outputs}
+                    self.save_manifest()
+                    done.add(name)
+                    print(f"[{name}] done in {time() - start:.0f}s")
+
+        return failed
@@ -1,14 +1,45 @@
 #!/usr/bin/env python3
 
 
-import sys
+import sys, os
+import json
+import hashlib
+import threading
 import cx_Oracle
 import traceback
 import re
 
+# rows fetched per round trip by the cursors of pooled connections
+ARRAYSIZE = 1000
+
+# session pools shared by all steps, one per database account
+session_pools = dict()
+session_pools_lock = threading.Lock()
+
+
+def get_session_pool(user, password, schema, max_sessions=4):
+    with session_pools_lock:
+        try:
+            return session_pools[(user, schema)]
+        except KeyError:
+            # threaded: sessions are acquired by steps running in parallel
+            pool = cx_Oracle.SessionPool(
+                user=user,
+                password=password,
+                dsn=schema,
+                min=1,
+                max=max_sessions,
+                increment=1,
+                threaded=True,
+                getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT,
+            )
+            session_pools[(user, schema)] = pool
+            return pool
+
 
 class pfam_duf:
     def __init__(self):
+        self.pool = None
         self.connection = None
         self.cursor = None
         self.list_duf = dict()
@@ -16,14 +47,15 @@ class pfam_duf:
 
     def getConnection(self, user, password, schema):
         """
-		Set database connection
+		Set database connection, acquired from the session pool of the account
 		"""
 
-        connectString = "".join([user, "/", password, "@", schema])
         try:
             # subprocess.run(["source", "~oracle/ora112setup.sh"])
-            self.connection = cx_Oracle.connect(connectString)
+            self.pool = get_session_pool(user, password, schema)
+            self.connection = self.pool.acquire()
             self.cursor = self.connection.cursor()
+            self.cursor.arraysize = ARRAYSIZE
         except:
             stackTrace = traceback.format_exc()
             print(stackTrace)
@@ -38,11 +70,13 @@ class pfam_duf:
 
     def close_connection(self):
         """
-		Close database connection
+		Release database connection to the session pool
 		"""
 
         self.cursor.close()
-        self.connection.close()
+        self.pool.release(self.connection)
+        self.connection = None
+        self.cursor = None
 
     def chunks(self, l, n):
         """Yield chunks of size n from iterable.
@@ -72,27 +106,88 @@ class pfam_duf:
             self.count_interpro_dom[row[2]] = 0
             self.list_duf[row[0]] = {"dufid": row[1], "ipr": row[2], "name": row[3]}
 
+    def get_release(self):
+        """
+		Return a key identifying the database release, and the versions of its databases
+		"""
+        self.cursor.execute("select dbcode, version from interpro.db_version order by dbcode")
+        versions = {dbcode: version for dbcode, version in self.cursor}
+
+        digest = hashlib.sha1(json.dumps(versions, sort_keys=True).encode()).hexdigest()
+        return digest[:12], versions
+
+    def get_pfam_duf_list_snapshot(self, directory, refresh=False):
+        """
+		DUF list of the current database release, read from a local snapshot
+		(one file per release) instead of querying the database again.
+		Return the release key and the versions of its databases
+		"""
+        release, versions = self.get_release()
+        path = os.path.join(directory, f"duf_list-{release}.json")
+
+        if not refresh and os.path.isfile(path):
+            print(f"Loading DUF list from {path}")
+            self.load_duf_list(path)
+            return release, versions
+
+        self.get_pfam_duf_list()
+        tmp_path = f"{path}.tmp"
+        self.save_duf_list(tmp_path)
+        os.replace(tmp_path, path)
+        return release, versions
+
+    def save_duf_list(self, outfile):
+        """
+		Save the DUF list as JSON, sorted so that unchanged lists give identical files
+		"""
+        with open(outfile, "w") as outf:
+            json.dump(self.list_duf, outf, indent=1, sort_keys=True)
+
+    def load_duf_list(self, infile):
+        with open(infile, "r") as f:
+            self.list_duf = json.load(f)
+
+        for pfamid, content in self.list_duf.items():
+            self.count_interpro_dom[content["ipr"]] = 0
+
+    def save_nb_domain_per_interpro(self, outfile):
+        with open(outfile, "w") as outf:
+            json.dump({ipr: count for ipr, count in self.count_interpro_dom.items() if ipr}, outf, indent=1, sort_keys=True)
+
+    def load_nb_domain_per_interpro(self, infile):
+        with open(infile, "r") as f:
+            self.count_interpro_dom.update(json.load(f))
+
     def get_nb_domain_per_interpro(self):
+        """
+		Average number of Pfam domains of the SwissProt proteins matched by each InterPro entry.
+		Entries are bound as a collection, so that the per-protein counts are computed once
+		"""
         print("Searching for average number of domains per InterPro entry")
-        ipr_chunks = list(self.chunks(list(self.count_interpro_dom.keys()), 1000))
-
-        for chunk in ipr_chunks:
-            list_ipr_quote = [f"'{ipr}'" for ipr in chunk]
-            request = f"select e2m.entry_ac, round(avg(sub.cpt)) \
-                    from entry2method e2m \
-                    join match m on m.method_ac=e2m.method_ac \
-                    join ( \
-                    select m.protein_ac, count(distinct method_ac) as cpt \
+        list_ipr = [ipr for ipr in self.count_interpro_dom if ipr]
+
+        # SYS.ODCIVARCHAR2LIST is a VARRAY(32767): more entries are bound in several queries
+        list_type = self.connection.gettype("SYS.ODCIVARCHAR2LIST")
+        for chunk in self.chunks(list_ipr, 32767):
+            entries = list_type.newobject()
+            entries.extend(chunk)
+
+            request = "with counts as ( \
+                    select m.protein_ac, count(distinct m.method_ac) as cpt \
                     from INTERPRO.MATCH m \
                     join INTERPRO.PROTEIN p on p.protein_ac=m.protein_ac \
                     where m.DBCODE='H' and p.DBCODE='S' and p.FRAGMENT='N' \
                     group by m.protein_ac \
-                    ) sub on sub.protein_ac = m.protein_ac \
-                    where e2m.entry_ac in ({','.join(list_ipr_quote)}) and m.DBCODE='H' \
+                    ) \
+                    select e2m.entry_ac, round(avg(c.cpt)) \
+                    from table(:entries) t \
+                    join entry2method e2m on e2m.entry_ac = t.column_value \
+                    join match m on m.method_ac=e2m.method_ac and m.DBCODE='H' \
+                    join counts c on c.protein_ac = m.protein_ac \
                     group by e2m.ENTRY_AC"
 
-            # print(request)
-            self.cursor.execute(request)
+            self.cursor.arraysize = 1000
+            self.cursor.execute(request, entries=entries)
             for row in self.cursor:
                 self.count_interpro_dom[row[0]] = row[1]
 
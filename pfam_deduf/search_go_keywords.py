@@ -1,23 +1,26 @@
 from search_swissprot import pfam_swiss
-import json, ssl
-from urllib import request
-from urllib.error import HTTPError
-from time import sleep
+import json
 
 
 class pfam_go(pfam_swiss):
-    def __init__(self):
-        super().__init__()
+    # maximum number of accessions per Proteins API request
+    BATCH_SIZE = 100
+
+    def __init__(self, workers=8, rate=10, cache=None, client=None):
+        super().__init__(workers, rate, cache, client)
 
     def get_list_duf_from_file(self, duf_file):
         with open(duf_file, "r") as f:
+            # skip header
+            next(f)
             for line in f:
                 # print(line)
+                # Status, Pfam identifier, Pfam short name, InterPro identifier, AVG number of domains per InterPro, ...
                 line = line.split("\t")
                 # print(line)
-                pfamid = line[0]
-                dufid = line[1]
-                nb_dom = line[3]
+                pfamid = line[1]
+                dufid = line[2]
+                nb_dom = line[4]
                 if nb_dom == "1":
                     # print(pfamid, dufid, nb_dom)
                     self.list_duf[pfamid] = {"dufid": dufid}
@@ -30,65 +33,70 @@ class pfam_go(pfam_swiss):
             swissprot_names, swissprot_acc, count_swissprot = self.output_list(BASE_URL)
             self.list_duf[pfamid]["swissprot_acc"] = swissprot_acc
 
+    def load_swissprot_accessions(self, infile):
+        with open(infile, "r") as f:
+            accessions = json.load(f)
+
+        for pfamid in self.list_duf:
+            self.list_duf[pfamid]["swissprot_acc"] = set(accessions.get(pfamid, []))
+
     def get_go_annotation(self):
         print("Searching GO and Keyword annotations")
+        # accessions matching several DUFs are only requested once
+        accessions = sorted({acc for pfamid in self.list_duf for acc in self.list_duf[pfamid]["swissprot_acc"]})
+        batches = [
+            accessions[i : i + self.BATCH_SIZE] for i in range(0, len(accessions), self.BATCH_SIZE)
+        ]
+
+        annotations = {}
+        for result in self.client.map(self.fetch_annotations, batches):
+            annotations.update(result)
+
         for pfamid in self.list_duf:
             list_go = set()
             list_keywords = set()
 
             for acc in self.list_duf[pfamid]["swissprot_acc"]:
-                BASE_URL = f"https://www.ebi.ac.uk/proteins/api/proteins/{acc}"
-
-                attempts = 0
-
-                # disable SSL verification to avoid config issues
-                context = ssl._create_unverified_context()
-
-                try:
-                    req = request.Request(BASE_URL, headers={"Accept": "application/json"})
-                    res = request.urlopen(req, context=context)
-                    # If the API times out due a long running query
-                    if res.status == 408:
-                        # wait just over a minute
-                        sleep(61)
-                        # then continue this loop with the same URL
-                        continue
-                    elif res.status == 204:
-                        # no data so leave loop
-                        break
-                    payload = json.loads(res.read().decode())
-                except HTTPError as e:
-                    if e.code == 408:
-                        sleep(61)
-                        continue
-                    else:
-                        # If there is a different HTTP error, it wil re-try 3 times before failing
-                        if attempts < 3:
-                            attempts += 1
-                            sleep(61)
-                            continue
-                        else:
-                            raise e
-
-                for i, item in enumerate(payload["dbReferences"]):
-                    if item["type"] == "GO":
-                        name = item["properties"]["term"]
-                        category = name.split(":")[0]
-                        # only save GO terms related to Biological process or Molecular function
-                        if category == "P" or category == "F":
-                            term = f"{item['id']}_{name}"
-                            list_go.add(term)
-
-                if "keywords" in payload:
-                    for i, item in enumerate(payload["keywords"]):
-                        keyword = item["value"]
-                        if keyword != "Reference proteome":
-                            list_keywords.add(keyword)
+                go_terms, keywords = annotations.get(acc, ((), ()))
+                list_go.update(go_terms)
+                list_keywords.update(keywords)
 
             self.list_duf[pfamid]["go_terms"] = list_go
             self.list_duf[pfamid]["keywords"] = list_keywords
             print(pfamid, list_go, list_keywords)
 
+    def fetch_annotations(self, accessions):
+        """
+		Return the GO terms and keywords of a batch of UniProt accessions,
+		only these fields of the Proteins API entries are kept
+		"""
+        url = f"https://www.ebi.ac.uk/proteins/api/proteins?offset=0&size={len(accessions)}&accession={','.join(accessions)}"
+        payload = self.client.get_json(url)
+
+        annotations = {}
+        for entry in payload or []:
+            list_go = set()
+            for i, item in enumerate(entry.get("dbReferences", [])):
+                if item["type"] == "GO":
+                    name = item["properties"]["term"]
+                    category = name.split(":")[0]
+                    # only save GO terms related to Biological process or Molecular function
+                    if category == "P" or category == "F":
+                        term = f"{item['id']}_{name}"
+                        list_go.add(term)
+
+            list_keywords = set()
+            for i, item in enumerate(entry.get("keywords", [])):
+                keyword = item["value"]
+                if keyword != "Reference proteome":
+                    list_keywords.add(keyword)
+
+            # entries requested with a secondary accession are returned under their primary one
+            for acc in [entry["accession"]] + entry.get("secondaryAccession", []):
+                annotations[acc] = (list_go, list_keywords)
+
+        return annotations
+
     def save_results_in_file(self, outputfile):
         print(f"Saving results in {outputfile}")
 
@@ -96,7 +104,7 @@ class pfam_go(pfam_swiss):
             outf.write("Status\tPfam identifier\tPfam short name\tList GO terms\tList keywords\n")
 
             for pfamid, content in self.list_duf.items():
-                list_go = " | ".join(content["go_terms"])
-                list_keywords = " | ".join(content["keywords"])
+                list_go = " | ".join(sorted(content["go_terms"]))
+                list_keywords = " | ".join(sorted(content["keywords"]))
                 if list_go != "" or list_keywords != "":
                     outf.write(f"\t{pfamid}\t{content['dufid']}\t{list_go}\t{list_keywords}\n")
@@ -1,154 +1,139 @@
 from deduf_utils import pfam_duf
-import sys, errno, re, json, ssl
-from urllib import request
-from urllib.error import HTTPError
-from time import sleep
+from ebi_api import api_client
+from urllib.parse import quote
 
 
 class pfam_litterature(pfam_duf):
-    def __init__(self):
+    # largest page sizes allowed by the annotations and search APIs
+    ANNOTATIONS_PAGE_SIZE = 8
+    SEARCH_PAGE_SIZE = 1000
+    # number of DUF identifiers OR-ed in one search query
+    SEARCH_BATCH_SIZE = 64
+
+    def __init__(self, workers=8, rate=10, cache=None, client=None):
         super().__init__()
+        # EuropePMC requests: at most `workers` queries at once, `rate` requests per second.
+        # A client shared with other steps also shares its rate limit
+        self.client = client or api_client(workers=workers, rate=rate, cache=cache)
+
+    def get_list_articles(self):
+        """
+		Search articles mentioning the DUF and Pfam identifiers of all DUFs.
+		Queries run concurrently, results are saved in the main thread
+		"""
+        print("Searching DUF and Pfam identifiers in literature")
+        pfamids = list(self.list_duf)
+
+        # identifiers shared by several Pfam entries are only searched once
+        dufids = sorted({self.list_duf[pfamid]["dufid"] for pfamid in pfamids})
+        batches = [
+            dufids[i : i + self.SEARCH_BATCH_SIZE] for i in range(0, len(dufids), self.SEARCH_BATCH_SIZE)
+        ]
+        articles_duf = {}
+        for result in self.client.map(self.search_articles_batch, batches):
+            articles_duf.update(result)
+
+        articles_pfam = self.client.map(self.fetch_articles_pfamid, pfamids)
+
+        for pfamid, list_pmid in zip(pfamids, articles_pfam):
+            self.list_duf[pfamid]["articles_pfam"] = list_pmid
+            self.list_duf[pfamid]["articles_duf"] = articles_duf[self.list_duf[pfamid]["dufid"]]
 
     def get_list_articles_pfamid(self, pfamid):
-        context = ssl._create_unverified_context()
-
-        next = f"https://www.ebi.ac.uk/europepmc/annotations_api/annotationsByEntity?entity={pfamid}&filter=1&format=JSON&pageSize=4"
-
-        last_page = False
-
-        attempts = 0
-        list_pmid = set()
-
-        while next:
-            try:
-                req = request.Request(next, headers={"Accept": "application/json"})
-                res = request.urlopen(req, context=context)
-                # If the API times out due a long running query
-                if res.status == 408:
-                    # wait just over a minute
-                    sleep(61)
-                    # then continue this loop with the same URL
-                    continue
-                elif res.status == 204:
-                    # no data so leave loop
-                    break
-                payload = json.loads(res.read().decode())
-                if len(payload["articles"]) > 0:
-                    if payload["nextCursorMark"] != -1:
-                        cursor = payload["nextCursorMark"]
-                        next = f"https://www.ebi.ac.uk/europepmc/annotations_api/annotationsByEntity?entity={pfamid}&filter=1&format=JSON&pageSize=4&cursorMark={cursor}"
-                    else:
-                        next = ""
-                else:
-                    next = ""
-                attempts = 0
-                if not next:
-                    last_page = True
-            except HTTPError as e:
-                if e.code == 408:
-                    sleep(61)
-                    continue
-                else:
-                    # If there is a different HTTP error, it wil re-try 3 times before failing
-                    if attempts < 3:
-                        attempts += 1
-                        sleep(61)
-                        continue
-                    else:
-                        sys.stderr.write("LAST URL: " + next)
-                        raise e
-
-            if len(payload["articles"]) != 0:
-                for i, item in enumerate(payload["articles"]):
-                    # print(item)
-                    pmid = item["extId"]
-                    # annotation = []
-                    # for j, ann in enumerate(item["annotations"]):
-                    #     prefix = ""
-                    #     postfix = ""
-                    #     try:
-                    #         prefix = ann["prefix"]
-                    #         postfix = ann["postfix"]
-                    #         annotation.append(f"{prefix} {pfamid} {postfix}")
-                    #     except KeyError as e:
-                    #         annotation.append(
-                    #             f"{pfamid} Term can be listed but not highlighted within the text"
-                    #         )
-
-                    # list_pmid
-                    list_pmid.add(pmid)
-
-                    # list_pmid.add(f"https://europepmc.org/article/MED/{pmid}")
-
-            # Don't overload the server, give it time before asking for more
-            if next:
-                sleep(1)
-
-        self.list_duf[pfamid]["articles_pfam"] = list_pmid
+        self.list_duf[pfamid]["articles_pfam"] = self.fetch_articles_pfamid(pfamid)
 
     def get_list_articles_duf(self, pfamid):
-
         dufid = self.list_duf[pfamid]["dufid"]
+        self.list_duf[pfamid]["articles_duf"] = self.search_articles(dufid)
 
-        # disable SSL verification to avoid config issues
-        context = ssl._create_unverified_context()
+    def fetch_articles_pfamid(self, pfamid):
+        BASE_URL = f"https://www.ebi.ac.uk/europepmc/annotations_api/annotationsByEntity?entity={pfamid}&filter=1&format=JSON&pageSize={self.ANNOTATIONS_PAGE_SIZE}"
 
-        next = f"https://www.ebi.ac.uk/europepmc/webservices/rest/search?query={dufid}&cursorMark=*&pageSize=50&format=json"
-        last_page = False
+        next = BASE_URL
+        list_pmid = set()
 
-        attempts = 0
+        while next:
+            payload = self.client.get_json(next)
+            if payload is None:
+                # no data so leave loop
+                break
+
+            if len(payload["articles"]) > 0 and payload["nextCursorMark"] != -1:
+                cursor = payload["nextCursorMark"]
+                next = f"{BASE_URL}&cursorMark={cursor}"
+            else:
+                next = ""
+
+            for i, item in enumerate(payload["articles"]):
+                pmid = item["extId"]
+                list_pmid.add(pmid)
+
+        return list_pmid
+
+    def search_articles_batch(self, dufids):
+        """
+		Search articles of a batch of DUF identifiers.
+
+		The identifiers are OR-ed in one query: a batch without hits is done in
+		a single request (most DUFs are not in the literature), otherwise it is
+		split in halves until single identifiers are left, which are searched
+		one by one.
+		"""
+        articles = {}
+        pending = [(dufids, None)]
+
+        while pending:
+            batch, hits = pending.pop()
+            if hits is None and len(batch) > 1:
+                hits = self.count_articles(batch)
+
+            if hits == 0:
+                for dufid in batch:
+                    articles[dufid] = set()
+                continue
+            elif len(batch) == 1:
+                articles[batch[0]] = self.search_articles(batch[0])
+                continue
+
+            middle = len(batch) // 2
+            left, right = batch[:middle], batch[middle:]
+            left_hits = self.count_articles(left)
+            pending.append((left, left_hits))
+            # if the left half has no hits, they are all in the right half
+            pending.append((right, hits if left_hits == 0 else None))
+
+        return articles
+
+    def count_articles(self, dufids):
+        query = quote(" OR ".join(dufids))
+        url = f"https://www.ebi.ac.uk/europepmc/webservices/rest/search?query={query}&resultType=idlist&pageSize=1&format=json"
+        payload = self.client.get_json(url)
+        return payload["hitCount"] if payload else 0
+
+    def search_articles(self, dufid):
+        BASE_URL = f"https://www.ebi.ac.uk/europepmc/webservices/rest/search?query={quote(dufid)}&resultType=idlist&pageSize={self.SEARCH_PAGE_SIZE}&format=json"
+
+        next = f"{BASE_URL}&cursorMark=*"
         list_pmid = set()
 
         while next:
-            try:
-                req = request.Request(next, headers={"Accept": "application/json"})
-                res = request.urlopen(req, context=context)
-                # If the API times out due a long running query
-                if res.status == 408:
-                    # wait just over a minute
-                    sleep(61)
-                    # then continue this loop with the same URL
-                    continue
-                elif res.status == 204:
-                    # no data so leave loop
-                    break
-                payload = json.loads(res.read().decode())
-                if payload["nextCursorMark"] != payload["request"]["cursorMark"]:
-                    cursor = payload["nextCursorMark"]
-                    next = f"https://www.ebi.ac.uk/europepmc/webservices/rest/search?query={dufid}&cursorMark={cursor}&pageSize=50&format=json"
-                else:
-                    next = ""
-                attempts = 0
-                if not next:
-                    last_page = True
-            except HTTPError as e:
-                if e.code == 408:
-                    sleep(61)
-                    continue
-                else:
-                    # If there is a different HTTP error, it wil re-try 3 times before failing
-                    if attempts < 3:
-                        attempts += 1
-                        sleep(61)
-                        continue
-                    else:
-                        sys.stderr.write("LAST URL: " + next)
-                        raise e
-
-            if len(payload["resultList"]["result"]) != 0:
-                for i, item in enumerate(payload["resultList"]["result"]):
-
-                    # add name to set of swissprot names
-                    if item["source"] == "MED":
-                        # print(item)
-                        pmid = item["pmid"]
-                        list_pmid.add(pmid)
-                        # list_pmid.add(f"https://europepmc.org/article/MED/{pmid}")
-
-            # Don't overload the server, give it time before asking for more
-            if next:
-                sleep(1)
-        self.list_duf[pfamid]["articles_duf"] = list_pmid
+            payload = self.client.get_json(next)
+            if payload is None:
+                # no data so leave loop
+                break
+
+            if payload["nextCursorMark"] != payload["request"]["cursorMark"]:
+                cursor = quote(payload["nextCursorMark"])
+                next = f"{BASE_URL}&cursorMark={cursor}"
+            else:
+                next = ""
+
+            for i, item in enumerate(payload["resultList"]["result"]):
+                if item["source"] == "MED":
+                    pmid = item["pmid"]
+                    list_pmid.add(pmid)
+
+        return list_pmid
 
     def save_result_in_file(self, outputfile):
         with open(outputfile, "w") as outf:
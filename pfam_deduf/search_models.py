@@ -20,6 +20,7 @@ class pfam_model(pfam_duf):
                 fpath = os.path.join(self.model_dir, f)
         count_not_in_model = len(self.list_duf) - count_in_model
         print(count_in_model, count_not_in_model)
+        return count_in_model, count_not_in_model
 
     def is_model_duf(self, pfam):
         if pfam in self.list_duf:
@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
 
 from deduf_utils import pfam_duf
-import sys, re, json, ssl
-from urllib import request
-from urllib.error import HTTPError
-from time import sleep
+from ebi_api import api_client
+import re
+import json
 
 
 class pfam_swiss(pfam_duf):
-    def __init__(self):
+    def __init__(self, workers=8, rate=10, cache=None, client=None):
         super().__init__()
         self.list_duf_unintegrated = dict()
+        # InterPro API requests: at most `workers` DUFs at once, `rate` requests per second.
+        # A client shared with other steps also shares its rate limit
+        self.client = client or api_client(workers=workers, rate=rate, cache=cache)
 
     def get_pfam_duf_list_unintegrated(self):
         request = "select m.method_ac, m.name \
@@ -25,13 +27,70 @@ class pfam_swiss(pfam_duf):
 
     def get_list_swissprot_names(self):
         print("Searching for SwissProt matches")
+        # DUFs are fetched concurrently, results are saved in the main thread
+        pfamids = list(self.list_duf)
+        results = self.client.map(self.fetch_swissprot_names, pfamids)
+        for pfamid, result in zip(pfamids, results):
+            self.save_swissprot_names(pfamid, *result)
+
+    def get_list_swissprot_names_pronto(self, pronto_uri, itersize=100000):
+        """
+		Same results as get_list_swissprot_names, from the Pronto database.
+		SwissProt matches of all DUFs are streamed with a server-side cursor
+		"""
+        print("Searching for SwissProt matches in Pronto")
+        m = re.match(r"([^/]+)/([^@]+)@([^:]+):(\d+)/(\w+)", pronto_uri)
+        if m is None:
+            raise ValueError("invalid Pronto connection string, expected user/password@host:port/dbname")
+
+        # only required for this source
+        import psycopg2
+
+        con = psycopg2.connect(
+            user=m.group(1), password=m.group(2), host=m.group(3), port=int(m.group(4)), dbname=m.group(5)
+        )
+
+        names = {pfamid: set() for pfamid in self.list_duf}
+        accessions = {pfamid: set() for pfamid in self.list_duf}
+
+        # named cursor: rows are fetched `itersize` at a time instead of all at once
+        cur = con.cursor("duf_swissprot")
+        cur.itersize = itersize
+        cur.execute(
+            """
+            SELECT sp.signature_acc, p.accession, n.text
+            FROM interpro.signature2protein sp
+            INNER JOIN interpro.protein p
+                ON sp.protein_acc = p.accession
+            LEFT OUTER JOIN interpro.protein2name pn
+                ON pn.protein_acc = sp.protein_acc
+            LEFT OUTER JOIN interpro.protein_name n
+                ON pn.name_id = n.name_id
+            WHERE p.is_reviewed = 't'
+            AND sp.signature_acc = ANY(%s)
+            """,
+            (list(self.list_duf),),
+        )
+
+        for pfamid, accession, name in cur:
+            accessions[pfamid].add(accession)
+            if name is not None:
+                names[pfamid].add(name)
+
+        cur.close()
+        con.close()
+
         for pfamid in self.list_duf:
-            self.get_list_swissprot_names_pfam(pfamid)
+            self.save_swissprot_names(pfamid, names[pfamid], accessions[pfamid], len(accessions[pfamid]))
 
     def get_list_swissprot_names_pfam(self, pfamid):
+        self.save_swissprot_names(pfamid, *self.fetch_swissprot_names(pfamid))
 
+    def fetch_swissprot_names(self, pfamid):
         BASE_URL = f"https://www.ebi.ac.uk:443/interpro/api/protein/reviewed/entry/pfam/{pfamid}/?page_size=200"
-        swissprot_names, swissprot_acc, count_swissprot = self.output_list(BASE_URL)
+        return self.output_list(BASE_URL)
+
+    def save_swissprot_names(self, pfamid, swissprot_names, swissprot_acc, count_swissprot):
         self.list_duf[pfamid]["swissprot"] = swissprot_names
         self.list_duf[pfamid]["swissprot_acc"] = swissprot_acc
         self.list_duf[pfamid]["swissprot_count"] = count_swissprot
@@ -49,7 +108,7 @@ class pfam_swiss(pfam_duf):
                 if content["swissprot_count"] != 0:
                     # keep DUF with SwissProt matches not Uncharacterized only
                     swissprotnames = ""
-                    for name in content["swissprot"]:
+                    for name in sorted(content["swissprot"]):
                         if not re.search("[Uu]ncharacterized", name) and not re.search("UPF", name):
                             swissprotnames += f"{name} | "
                     if swissprotnames != "":
@@ -59,47 +118,29 @@ class pfam_swiss(pfam_duf):
                             f"\t{pfamid}\t{content['dufid']}\t{ipr}\t{ipr_count}\t{content['name']}\t{content['swissprot_count']}\t{swissprotnames}\n"
                         )
 
-    def output_list(self, BASE_URL):
-        # disable SSL verification to avoid config issues
-        context = ssl._create_unverified_context()
+    def save_swissprot_accessions(self, outputfile):
+        with open(outputfile, "w") as outf:
+            json.dump(
+                {pfamid: sorted(content["swissprot_acc"]) for pfamid, content in self.list_duf.items()},
+                outf,
+                indent=1,
+                sort_keys=True,
+            )
 
+    def output_list(self, BASE_URL):
         next = BASE_URL
 
-        attempts = 0
         list_names = set()
         count_swissprot = 0
         list_accessions = set()
 
+        # pages are requested through the shared client: retries and politeness are handled there
         while next:
-            try:
-                req = request.Request(next, headers={"Accept": "application/json"})
-                res = request.urlopen(req, context=context)
-                # If the API times out due a long running query
-                if res.status == 408:
-                    # wait just over a minute
-                    sleep(61)
-                    # then continue this loop with the same URL
-                    continue
-                elif res.status == 204:
-                    # no data so leave loop
-                    break
-                payload = json.loads(res.read().decode())
-                next = payload["next"]
-                attempts = 0
-
-            except HTTPError as e:
-                if e.code == 408:
-                    sleep(61)
-                    continue
-                else:
-                    # If there is a different HTTP error, it wil re-try 3 times before failing
-                    if attempts < 3:
-                        attempts += 1
-                        sleep(61)
-                        continue
-                    else:
-                        sys.stderr.write("LAST URL: " + next)
-                        raise e
+            payload = self.client.get_json(next)
+            if payload is None:
+                # no data so leave loop
+                break
+            next = payload["next"]
 
             count_swissprot = payload["count"]
             for i, item in enumerate(payload["results"]):
@@ -111,9 +152,5 @@ class pfam_swiss(pfam_duf):
                 list_names.add(item["metadata"]["name"])
                 list_accessions.add(item["metadata"]["accession"])
 
-            # Don't overload the server, give it time before asking for more
-            if next:
-                sleep(1)
-
         # print(list_names, list_accessions, count_swissprot)
         return list_names, list_accessions, count_swissprot